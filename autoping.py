@@ -1,8 +1,15 @@
 from util.commons import *
 from util.configureExperiment import setup_configuration
-from util.exprunner import validate_ip_list, run_ping_measurments
+from util.resolver import HostsResolver
+from util.geodb import open_geodb
+from util.exprunner import validate_ip_list, run_ping_measurments, run_paired_ping_measurments, \
+    run_pipelined_measurments, validate_remaining_lines
+from util.monitor import run_monitoring
+from util.journal import CampaignJournal, JOURNAL_FILE
+from util.adaptive import StoppingRule
+from util.logarchive import import_logs
 from util.postprocess import process_logs
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
 
 usage = """Run this script without arguments or, if you have a configuration-file, pass it via the -c (--config) option.
@@ -10,9 +17,51 @@ usage = """Run this script without arguments or, if you have a configuration-fil
     -c (or --config)      OPTIONAL argument to provide a configuration file
     -n (or --numping)     OPTIONAL argument to indicate the number of icmp_echo_request to be sent
                           with each ping command. The default value is 100
+    --adaptive            OPTIONAL argument to stop pinging a target as soon as the 95%% confidence interval of its
+                          mean RTT is narrower than ADAPTIVE ms. --numping becomes the maximum number of echo requests
+                          per target; the number actually sent is the TX column of the results (Linux/macOS only)
+    --min-probes          OPTIONAL argument to indicate the minimum number of echo requests sent to each target
+                          with --adaptive. The default value is 10
     -p (or --postprocess) OPTIONAL argument to provide the folder that contains the log that must be postprocessed.
                           If --postprocess is set, the script will just postprocess logs, without performing new experiments
-    -j (or --numcores)    OPTIONAL argument to indicate how many processes shall be used to launch many ping commands in parallel
+    --format              OPTIONAL argument to also save the results in a typed columnar file next to the CSV:
+                          csv (default, CSV only), parquet or feather. rtt_plotter loads these files directly
+    --archive             OPTIONAL flag to move each log (and its samples) into the compressed segments of out_v4/out_v6
+                          as soon as its ping ends, instead of keeping one file per ping (not allowed with --every).
+                          --postprocess reads the archived logs transparently
+    --import-logs         OPTIONAL argument to provide a folder of .txt logs to be moved into its compressed archive
+    --probe-store         OPTIONAL flag to add every echo request of the postprocessed logs (seq, send time, rtt, lost)
+                          to the memory-mapped store probes_v4/probes_v6, and to save per-target statistics over all
+                          the stored probes (percentiles, jitter, longest loss burst) to probe_stats_v4/v6.csv
+    --incremental         OPTIONAL flag to postprocess only the logs that are new or changed since the last postprocessing
+                          of the same folder, adding their results to the existing results file
+    --hosts               OPTIONAL argument to provide a hosts file used to resolve the QDNs of IPlist.txt,
+                          instead of querying the DNS
+    --geodb               OPTIONAL argument to provide an offline geolocation/ASN database (a CSV file with a "network"
+                          column and the ip-api.com fields, or its .npz index) used instead of ip-api.com
+    -j (or --numcores)    OPTIONAL argument to indicate how many ping commands can run in parallel.
+                          All of them are supervised by a single process. The default value is 50
+    -e (or --engine)      OPTIONAL argument to choose how echo requests are sent: system (default) runs the ping
+                          command of the OS, native sends them from this process through ICMP sockets (Linux/macOS only)
+    --paired              OPTIONAL flag to ping the IPv4 and the IPv6 address of each QDN in the same time window,
+                          alternating their echo requests, instead of running the IPv4 and then the IPv6 campaign
+    --pipeline            OPTIONAL flag to start pinging each target as soon as it has been validated,
+                          overlapping the validation of IPlist.txt with the measurements (not allowed with --every)
+    --rate                OPTIONAL argument to cap the aggregate number of echo requests per second of the whole campaign.
+                          It can also be set with the "rate" key of the configuration file
+    --dest-rate           OPTIONAL argument to cap the number of echo requests per second sent to the same destination.
+                          It can also be set with the "dest_rate" key of the configuration file
+    --every               OPTIONAL argument to keep monitoring the validated targets, starting a new round of pings
+                          every EVERY seconds until SIGINT or SIGTERM. Rolling statistics are saved to rolling_v4/v6.csv
+    --window              OPTIONAL argument to indicate how many RTT samples per target are kept by the rolling
+                          statistics of --every. The default value is 10000
+    --rotate-every        OPTIONAL argument to rotate out_v4 and out_v6 every ROTATE_EVERY rounds of --every.
+                          The default value is 24 (0 disables rotation). Every folder is postprocessed before
+                          being rotated, and its results are appended to the results file
+    --keep-rotated        OPTIONAL argument to indicate how many rotated output folders are kept (default: all)
+    --resume              OPTIONAL flag to resume the last interrupted campaign from campaign_journal.jsonl:
+                          only the targets not measured yet (or failed) are pinged again, with the configuration
+                          and the number of pings of the interrupted campaign
     \n"""
 examplescript = "Try with this:\npython3 autoping.py"
 desc = """This is a script to configure and perform ping experiments, also elaborating and recording data.
@@ -20,15 +69,73 @@ desc = """This is a script to configure and perform ping experiments, also elabo
     University of Brescia, AA 2020/21.
     The || sign means a choice -logical OR. Options are case sensitive."""
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
+
+def positive_float(value):
+    number = float(value)
+    if number <= 0:
+        raise ArgumentTypeError("{} is not a positive number".format(value))
+    return number
+
+def non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise ArgumentTypeError("{} is not a non-negative integer".format(value))
+    return number
+
+
 parser = ArgumentParser(description=desc, usage=usage+examplescript)
 parser.add_argument("-c", "--config", dest="configfile", required=False,
                     default="", action="store")
 parser.add_argument("-n", "--numping", dest="numping", required=False,
                     default="100", action="store")
+parser.add_argument("--adaptive", dest="adaptive", required=False, type=positive_float,
+                    default=None, action='store')
+parser.add_argument("--min-probes", dest="min_probes", required=False, type=positive_int,
+                    default=10, action='store')
 parser.add_argument("-p", "--postprocess", dest="postprocess", required=False,
                     default="", action='store')
-parser.add_argument("-j", "--numcores", dest="numcores", required=False, type=int, choices=range(1, 33),
-                    default=4, action='store')
+parser.add_argument("--format", dest="out_format", required=False, choices=['csv', 'parquet', 'feather'],
+                    default='csv', action='store')
+parser.add_argument("--archive", dest="archive", required=False, default=False,
+                    action='store_true')
+parser.add_argument("--import-logs", dest="import_logs", required=False,
+                    default=None, action='store')
+parser.add_argument("--probe-store", dest="probe_store", required=False, default=False,
+                    action='store_true')
+parser.add_argument("--incremental", dest="incremental", required=False, default=False,
+                    action='store_true')
+parser.add_argument("--hosts", dest="hostsfile", required=False,
+                    default=None, action='store')
+parser.add_argument("--geodb", dest="geodb", required=False,
+                    default=None, action='store')
+parser.add_argument("-j", "--numcores", dest="numcores", required=False, type=positive_int,
+                    default=50, action='store')
+parser.add_argument("-e", "--engine", dest="engine", required=False, choices=['system', 'native'],
+                    default='system', action='store')
+parser.add_argument("--paired", dest="paired", required=False, default=False,
+                    action='store_true')
+parser.add_argument("--pipeline", dest="pipeline", required=False, default=False,
+                    action='store_true')
+parser.add_argument("--rate", dest="rate", required=False, type=positive_float,
+                    default=None, action='store')
+parser.add_argument("--dest-rate", dest="dest_rate", required=False, type=positive_float,
+                    default=None, action='store')
+parser.add_argument("--every", dest="every", required=False, type=positive_float,
+                    default=None, action='store')
+parser.add_argument("--window", dest="window", required=False, type=positive_int,
+                    default=10000, action='store')
+parser.add_argument("--rotate-every", dest="rotate_every", required=False, type=non_negative_int,
+                    default=24, action='store')
+parser.add_argument("--keep-rotated", dest="keep_rotated", required=False, type=positive_int,
+                    default=None, action='store')
+parser.add_argument("--resume", dest="resume", required=False, default=False,
+                    action='store_true')
 
 OS = 'undefined'
 
@@ -40,6 +147,33 @@ def check_OS():
         exit()
 
 
+def build_stopping_rule(args, howmany):
+    if not args.adaptive:
+        return None
+    if OS != 'posix':
+        # su Windows non si puo' interrompere ping lasciandogli stampare le statistiche
+        print("--adaptive is only available on Linux and macOS")
+        exit()
+    print("Adaptive probe count: each target is pinged until the 95% confidence interval of its mean RTT "
+          "is narrower than {}ms ({} to {} echo requests)".format(args.adaptive, args.min_probes, howmany))
+    return StoppingRule(args.adaptive, min_probes=args.min_probes)
+
+
+def probe_store_folder(args, ip_version):
+    return "probes_v{}".format(ip_version) if args.probe_store else None
+
+
+# versioni IP i cui risultati sono gia' stati salvati: con --every ogni cartella ruotata
+# viene elaborata prima della rotazione e i suoi risultati sono accodati a quelli precedenti
+appended_results = set()
+
+def postprocess_folder(logfolder, ip_version):
+    errors = process_logs(logfolder, OS, ip_version, incremental=args.incremental, out_format=args.out_format,
+                          store=probe_store_folder(args, ip_version), append=ip_version in appended_results)
+    appended_results.add(ip_version)
+    return errors
+
+
 def check_requirements():
     global iplistfile
     iplistfile = 'IPlist.txt'
@@ -59,20 +193,104 @@ if __name__ == "__main__":
 
     # FASE 0: controllo requisiti e customizzazione OS-dependent
     check_OS()
-    if not only_postprocess:
+    if args.import_logs:
+        if not os.path.isdir(args.import_logs):
+            print("Log folder {} cannot be found ".format(args.import_logs))
+            exit()
+        num_logs = import_logs(args.import_logs)
+        print("{} logs moved into the archive of {}".format(num_logs, args.import_logs))
+        exit()
+
+    if not only_postprocess and args.resume:
+        # FASE 1-2 di una campagna interrotta: configurazione e target validati sono nel journal
+        try:
+            journal = CampaignJournal.load(JOURNAL_FILE)
+        except Exception as e:
+            print(e)
+            exit()
+        # la validazione puo' essere stata interrotta prima della fine della lista
+        validate_remaining_lines(journal, client=open_geodb(args.geodb) if args.geodb else None,
+                                 resolver=HostsResolver(args.hostsfile) if args.hostsfile else None)
+        if not journal.targets:
+            print("Cannot resume: {} holds no validated targets".format(JOURNAL_FILE))
+            exit()
+        print("Resuming the campaign of {}: {} targets done, {} to be pinged again".format(
+            JOURNAL_FILE, journal.count('done'), len(journal.targets) - journal.count('done')))
+        if args.paired or args.pipeline or args.every:
+            print("--paired, --pipeline and --every are ignored when resuming a campaign")
+        config, howmany = journal.config, journal.howmany
+        rule = build_stopping_rule(args, howmany)
+        max_rate = args.rate or config.get('rate')
+        dest_rate = args.dest_rate or config.get('dest_rate')
+        outdir_v4 = run_ping_measurments(journal.unfinished(4), howmany, config, OS, args.numcores, ip_version=4,
+                                         engine=args.engine, max_rate=max_rate, dest_rate=dest_rate,
+                                         journal=journal, rule=rule, archive=args.archive)
+        outdir_v6 = run_ping_measurments(journal.unfinished(6), howmany, config, OS, args.numcores, ip_version=6,
+                                         engine=args.engine, max_rate=max_rate, dest_rate=dest_rate,
+                                         journal=journal, rule=rule, archive=args.archive)
+        journal.close()
+        print("-"*60)
+
+    elif not only_postprocess:
         check_requirements()
 
         # FASE 1: configurazione esperimento (con o senza configuration file)
         config = setup_configuration(args.configfile)
 
         # FASE 2: esecuzione esperimenti
-        ping_list_v4, ping_list_v6 = validate_ip_list(iplistfile)
-
         howmany = args.numping
-        numcores = args.numcores
+        num_parallel = args.numcores
+        engine = args.engine
+        if engine == 'native' and OS != 'posix':
+            print("The native engine is only available on Linux and macOS")
+            exit()
+        if args.pipeline and args.every:
+            print("--pipeline cannot be used together with --every")
+            exit()
+        if args.archive and args.every:
+            print("--archive cannot be used together with --every")
+            exit()
+        # i limiti passati da riga di comando prevalgono su quelli del configuration file
+        max_rate = args.rate or config.get('rate')
+        dest_rate = args.dest_rate or config.get('dest_rate')
+        rule = build_stopping_rule(args, howmany)
+
+        resolver = HostsResolver(args.hostsfile) if args.hostsfile else None
+        # senza --geodb la geolocalizzazione viene chiesta a ip-api.com
+        client = open_geodb(args.geodb) if args.geodb else None
+        # lo stato di ogni target viene registrato nel journal, per poter riprendere
+        # la campagna con --resume se viene interrotta (il monitoraggio continuo non ne ha bisogno)
+        journal = CampaignJournal.create(config, howmany) if not args.every else None
+        if args.pipeline:
+            outdir_v4, outdir_v6 = run_pipelined_measurments(iplistfile, howmany, config, OS, num_parallel,
+                                                             engine=engine, paired=args.paired, max_rate=max_rate,
+                                                             dest_rate=dest_rate, client=client, resolver=resolver,
+                                                             journal=journal, rule=rule, archive=args.archive)
+        else:
+            # i target validati finiscono nel journal riga per riga, durante la validazione
+            ping_list_v4, ping_list_v6 = validate_ip_list(iplistfile, client=client, resolver=resolver,
+                                                          journal=journal)
 
-        outdir_v4 = run_ping_measurments(ping_list_v4, howmany, config, OS, numcores, ip_version=4)
-        outdir_v6 = run_ping_measurments(ping_list_v6, howmany, config, OS, numcores, ip_version=6)
+            if args.every:
+                outdir_v4, outdir_v6 = run_monitoring(ping_list_v4, ping_list_v6, howmany, config, OS, num_parallel,
+                                                      args.every, engine=engine, paired=args.paired,
+                                                      max_rate=max_rate, dest_rate=dest_rate, window=args.window,
+                                                      rotate_every=args.rotate_every, keep=args.keep_rotated,
+                                                      rule=rule, process=postprocess_folder)
+            elif args.paired:
+                outdir_v4, outdir_v6 = run_paired_ping_measurments(ping_list_v4, ping_list_v6, howmany, config, OS,
+                                                                   num_parallel, engine=engine,
+                                                                   max_rate=max_rate, dest_rate=dest_rate,
+                                                                   journal=journal, rule=rule, archive=args.archive)
+            else:
+                outdir_v4 = run_ping_measurments(ping_list_v4, howmany, config, OS, num_parallel, ip_version=4,
+                                                 engine=engine, max_rate=max_rate, dest_rate=dest_rate,
+                                                 journal=journal, rule=rule, archive=args.archive)
+                outdir_v6 = run_ping_measurments(ping_list_v6, howmany, config, OS, num_parallel, ip_version=6,
+                                                 engine=engine, max_rate=max_rate, dest_rate=dest_rate,
+                                                 journal=journal, rule=rule, archive=args.archive)
+        if journal is not None:
+            journal.close()
 
         print("-"*60)
 
@@ -84,11 +302,15 @@ if __name__ == "__main__":
             exit()
         logfolder = args.postprocess
         ip_version = 4 if "v4" in logfolder else 6
-        errors = process_logs(logfolder, OS, ip_version)
+        errors = process_logs(logfolder, OS, ip_version, incremental=args.incremental,
+                              out_format=args.out_format, store=probe_store_folder(args, ip_version))
         exit()
     
+    # con --every una cartella ruotata nell'ultimo round e' gia' stata elaborata (None)
     logfolder_v4 = outdir_v4
-    errors_v4 = process_logs(logfolder_v4, OS, ip_version=4)
+    if logfolder_v4 is not None:
+        errors_v4 = postprocess_folder(logfolder_v4, ip_version=4)
 
     logfolder_v6 = outdir_v6
-    errors_v6 = process_logs(logfolder_v6, OS, ip_version=6)
\ No newline at end of file
+    if logfolder_v6 is not None:
+        errors_v6 = postprocess_folder(logfolder_v6, ip_version=6)
\ No newline at end of file
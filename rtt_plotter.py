@@ -1,19 +1,29 @@
 import os
 import sys
 import pandas as pd
+import numpy as np
 import pycountry_convert as pc
 # pycountry.countries.get(alpha_2='DE')
 import seaborn as sns
 from argparse import ArgumentParser
 from datetime import datetime
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import inspect
+import matplotlib
+# i plot sono solo salvati su file: backend non interattivo, usabile anche dai processi del pool
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
 from matplotlib.ticker import FuncFormatter
 from matplotlib.ticker import (AutoMinorLocator, MultipleLocator)
-from pandas_schema import Column, Schema
-from pandas_schema.validation import DateFormatValidation, MatchesPatternValidation, InRangeValidation, InListValidation
 import code  # code.interact(local=dict(globals(), **locals()))
+from util.results import read_results, load_results_folder, order_categories
+from util.probestore import ProbeStore
+from util.plotcache import PlotCache, cache_key
+from util.aggregate import FineHistogram, thin_groups, rasterize_dense
+from util.validation import Column, Schema, DateFormatValidation, MatchesPatternValidation, InRangeValidation, InListValidation
 
 import warnings
 
@@ -23,68 +33,60 @@ def main():
     # Importante fornire come argomenti sia il file .csv dei risultati delle misure con IPv4
     # che quello dei risultati delle misure con IPv6.
     args = parser.parse_args()
-    finput_v4 = args.finput_v4
-    finput_v6 = args.finput_v6
+    inputs = [(4, args.finput_v4), (6, args.finput_v6)]
 
     # Abbiamo deciso di differenziare le cartelle dei plot in base alla versione IP,
     # in modo tale da separare i due risultati.
-
-    #IPv4
-    if not os.path.exists(finput_v4):
-        print("{} does not exists".format(finput_v4), file=sys.stderr)
-        exit()
-
-    print("Loading and Validating data from IPv4 measurements...")
-    data = load_data(finput_v4)
-
-    print("\nData Loading Completed!")
-    print(data)
-
-    '''
-    BUILD OUTPUT FOLDERS
-    '''
-    out_folders = ['plot_v4', 'plot_v4/RTT', 'plot_v4/SD', 'plot_v4/LOSSES']
-    for folder in out_folders:
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-
-    # Plot something nice :)
-    print("\nNow plotting...")
-    plotting(data, out_folders[0])
-
-    print("\n\n\n")
-
-    #IPv6
-    if not os.path.exists(finput_v6):
-        print("{} does not exists".format(finput_v6), file=sys.stderr)
-        exit()
-
-    print("Loading and Validating data from IPv6 measurements...")
-    data = load_data(finput_v6)
-
-    print("\nData Loading Completed!")
-    print(data)
-
-    '''
-    BUILD OUTPUT FOLDERS
-    '''
-    out_folders = ['plot_v6', 'plot_v6/RTT', 'plot_v6/SD', 'plot_v6/LOSSES']
-    for folder in out_folders:
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-
+    jobs = []
+    for ip_version, finput in inputs:
+        if not os.path.exists(finput):
+            print("{} does not exists".format(finput), file=sys.stderr)
+            # come in origine: i plot dei dati gia' caricati vengono disegnati, poi lo script termina
+            if jobs:
+                render_jobs(jobs, args)
+            exit()
+
+        print("Loading and Validating data from IPv{} measurements...".format(ip_version))
+        plot_data[ip_version] = load_data(finput, use_cache=not args.no_cache)
+
+        print("\nData Loading Completed!")
+        print(plot_data[ip_version])
+
+        '''
+        BUILD OUTPUT FOLDERS
+        '''
+        plot_folder = 'plot_v{}'.format(ip_version)
+        for folder in [plot_folder, plot_folder+'/RTT', plot_folder+'/SD', plot_folder+'/LOSSES']:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+        jobs += plotting(ip_version, plot_folder)
+        store = find_probe_store(finput, ip_version)
+        if store is not None:
+            jobs += plot_probe_store(store, ip_version, plot_folder)
+        print("\n\n\n")
+
+    render_jobs(jobs, args)
+
+
+def render_jobs(jobs, args):
     # Plot something nice :)
-    print("\nNow plotting...")
-    plotting(data, out_folders[0])
+    print("Now plotting... ({} plots)".format(len(jobs)))
+    cache = None if args.no_cache else PlotCache(max_size=args.cache_size*1024*1024)
+    render_all(jobs, args.workers, cache)
 
 
 usage = """The user MUST use the -f (or --finput) option to let this script find a file or a folder with results
             to process and plot
 
         -h (or --help)                   show this help message and exit
-        -fv4 (or --finputv4) REQUIRED    A path to a IPv4 result (csv) file or to a folder that contains
-        -fv6 (or --finputv6) REQUIRED    A path to a IPv6 result (csv) file or to a folder that contains
+        -fv4 (or --finputv4) REQUIRED    A path to a IPv4 result (csv, parquet or feather) file or to a folder that contains
+        -fv6 (or --finputv6) REQUIRED    A path to a IPv6 result (csv, parquet or feather) file or to a folder that contains
         more of such csv files
+        -w (or --workers)    OPTIONAL    Number of processes drawing the plots in parallel (default: one per CPU core)
+        --no-cache           OPTIONAL    Render every plot, without using the cache of the unchanged plots (.plot_cache),
+                                         and read again every results file of a folder (.results_cache)
+        --cache-size         OPTIONAL    Maximum size of the plot cache in MB (default: 500)
     \n"""
 examplescript = "Try with this:\npython3 rtt_plotter.py -f ./"
 desc = """This is a script to post-process rtt measurements, analyse and plot them.
@@ -96,6 +98,12 @@ parser.add_argument("-fv4", "--finputv4", dest="finput_v4", required=True,
                     action="store")
 parser.add_argument("-fv6", "--finputv6", dest="finput_v6", required=True,
                     action="store")
+parser.add_argument("-w", "--workers", dest="workers", required=False, type=int, default=None,
+                    action="store")
+parser.add_argument("--no-cache", dest="no_cache", required=False, default=False,
+                    action="store_true")
+parser.add_argument("--cache-size", dest="cache_size", required=False, type=int, default=500,
+                    action="store")
 
 
 def validate(df, ip_version):
@@ -120,7 +128,7 @@ def validate(df, ip_version):
             Column('avgRTT', [InRangeValidation(1.0, 2000.0)], allow_empty=True),
             Column('maxRTT', [InRangeValidation(1.0, 3000.0)], allow_empty=True),
             Column('mdevRTT', [InRangeValidation(0, 400)], allow_empty=True),
-            Column('TX', [InRangeValidation(50, 1000)]),
+            Column('TX', [InRangeValidation(1, 1000)]),
             Column('RX', [InRangeValidation(0, 1000)]),
             Column('lost', [InRangeValidation(0.0, 100.000000001)])
         ])
@@ -145,18 +153,19 @@ def validate(df, ip_version):
             Column('avgRTT', [InRangeValidation(1.0, 2000.0)], allow_empty=True),
             Column('maxRTT', [InRangeValidation(1.0, 3000.0)], allow_empty=True),
             Column('mdevRTT', [InRangeValidation(0, 400)], allow_empty=True),
-            Column('TX', [InRangeValidation(50, 1000)]),
+            Column('TX', [InRangeValidation(1, 1000)]),
             Column('RX', [InRangeValidation(0, 1000)]),
             Column('lost', [InRangeValidation(0.0, 100.000000001)])
         ])
 
-    errors = schema.validate(df)
+    # extra columns (e.g. the RTT percentiles) are carried along without being validated
+    errors = schema.validate(df[schema.get_column_names()])
 
     for error in errors:
         print(error)
 
     errors_index_rows = set([e.row for e in errors])
-    data_clean = df.drop(index=errors_index_rows)
+    data_clean = order_categories(df.drop(index=errors_index_rows))
     index = ['name', 'surname', 'IP', 'datetime']
     data_clean.set_index(index)
     return data_clean
@@ -171,135 +180,190 @@ def world_cat_setter(country, continent):
         return 'nonEU'
 
 
-def load_data(finput):
+# continente e categoria (IT, EU, nonEU) di ogni paese già incontrato
+country_dimensions = {}
+
+
+def lookup_country(country):
+    if country not in country_dimensions:
+        continent = pc.country_alpha2_to_continent_code(country)
+        country_dimensions[country] = (continent, world_cat_setter(country, continent))
+    return country_dimensions[country]
+
+
+def add_country_dimensions(df):
+    # la tabella si calcola una volta per paese e si applica a tutte le righe con i codici delle categorie
+    countries = df['country'].astype('category')
+    codes = countries.cat.codes.to_numpy()
+    # le categorie dei paesi scartati dalla validazione (non più usate) restano senza continente
+    used = np.bincount(codes[codes >= 0], minlength=len(countries.cat.categories)) > 0
+    dimensions = [lookup_country(country) if u else (None, None)
+                  for country, u in zip(countries.cat.categories, used)]
+    for i, column in enumerate(['continent', 'worldcat']):
+        values = pd.Categorical([d[i] for d in dimensions])
+        # il codice -1 (paese mancante) resta -1
+        df[column] = pd.Categorical.from_codes(np.append(values.codes, -1)[codes], categories=values.categories)
+    return order_categories(df, ['continent', 'worldcat'])
+
+
+def find_results_files(folder):
+    # se degli stessi risultati esiste anche la copia Parquet/Feather, si legge quella
+    files = {}
+    for extension in ['.csv', '.feather', '.parquet']:
+        for file in glob(folder+os.sep+'results_*_*_v*'+extension):
+            files[os.path.splitext(file)[0]] = file
+    return sorted(files.values())
+
+
+# colonne dei risultati usate da validate e dai plot
+RESULTS_COLUMNS = ['name', 'surname', 'cap', 'operator', 'poa', 'accessTech', 'localTech', 'country',
+                   'datetime', 'IP', 'minRTT', 'avgRTT', 'maxRTT', 'mdevRTT', 'TX', 'RX', 'lost']
+
+
+def load_data(finput, use_cache=True):
     if os.path.isfile(finput):
-        df = pd.read_csv(finput, header=0)
+        df = read_results(finput, RESULTS_COLUMNS)
     elif os.path.isdir(finput):
-        csvfiles = glob(finput+os.sep+'results_*_*_v*.csv')
-        dataframes = []
-        for file in csvfiles:
-            df = pd.read_csv(file, header=0)
-            dataframes.append(df)
-        df = pd.concat(dataframes, ignore_index=True)
-        aggregate_num_records = sum([len(df) for df in dataframes])
-        assert aggregate_num_records == len(df)
+        # i file dei vari contributori letti in parallelo, senza righe duplicate, con cache nella cartella
+        df = load_results_folder(finput, find_results_files(finput), RESULTS_COLUMNS, use_cache=use_cache)
 
     ip_version = 4 if "v4" in finput else 6
 
     valid = validate(df, ip_version)
     # add continent and world-category columns after validation
-    valid['continent'] = valid.apply(
-        lambda row: pc.country_alpha2_to_continent_code(row['country']), axis=1)
-    valid['worldcat'] = valid.apply(lambda row: world_cat_setter(
-        row['country'], row['continent']), axis=1)
-    return valid
-
-
-def plot_histograms(df, plot_folder):
-    print("HIST RTT...")
-    data = df.avgRTT
-    bin_widths = [5, 10, 20]
-    for bw in bin_widths:
-        ax = data.hist(bins=range(1, int(max(data))+bw, bw))
-        ax.yaxis.set_major_formatter(FuncFormatter(lambda y, _: '{:.0f}'.format(
-            y/len(data)*100)))  # '{0:.0%}'.format(y/len(data)
-        plt.xlabel('Mean RTT [ms]')
-        plt.ylabel('Relative Frequency [%]')
-        plt.title(
-            'Histogram for the Mean RTT (bin-width = {})'.format(bw, int(max(data)/bw)))
-        plt.xlim(1, max(data))
-        tick_factor = 2 if bw < 10 else 1
-        ticks = range(1, int(max(data))+bw, tick_factor*bw)
-        fs = 8
-        plt.xticks(ticks, rotation=90, fontsize=fs)
-        ax.xaxis.set_minor_locator(AutoMinorLocator(bw))
-        ax.grid(which='minor', axis='x', alpha=0.5)
-        ax.grid(which='major', axis='x', alpha=1)
-        plt.minorticks_on()
-        plt.tight_layout()
-        plt.subplots_adjust(left=0.1, right=0.95, top=0.9, bottom=0.13)
-        plt.savefig(plot_folder+'/RTT/hist_meanRTT_bw={}.pdf'.format(bw), format='pdf')
-        plt.clf()
+    return add_country_dimensions(valid)
+
+
+def draw_histogram(hist, bins):
+    # same bars of Series.hist, drawn from the counts of the pre-aggregated histogram
+    counts = hist.coarse(bins)
+    edges = np.asarray(bins, dtype=np.float64)
+    plt.hist(edges[:-1], bins=edges, weights=counts)
+    ax = plt.gca()
+    ax.grid(True)
+    return ax
+
+
+def hist_mean_rtt(hist, filename, bw):
+    print("HIST RTT (bin-width = {})...".format(bw))
+    ax = draw_histogram(hist, range(1, int(hist.max)+bw, bw))
+    ax.yaxis.set_major_formatter(FuncFormatter(lambda y, _: '{:.0f}'.format(
+        y/hist.rows*100)))  # '{0:.0%}'.format(y/len(data)
+    plt.xlabel('Mean RTT [ms]')
+    plt.ylabel('Relative Frequency [%]')
+    plt.title(
+        'Histogram for the Mean RTT (bin-width = {})'.format(bw, int(hist.max/bw)))
+    plt.xlim(1, hist.max)
+    tick_factor = 2 if bw < 10 else 1
+    ticks = range(1, int(hist.max)+bw, tick_factor*bw)
+    fs = 8
+    plt.xticks(ticks, rotation=90, fontsize=fs)
+    ax.xaxis.set_minor_locator(AutoMinorLocator(bw))
+    ax.grid(which='minor', axis='x', alpha=0.5)
+    ax.grid(which='major', axis='x', alpha=1)
+    plt.minorticks_on()
+    plt.tight_layout()
+    plt.subplots_adjust(left=0.1, right=0.95, top=0.9, bottom=0.13)
+    plt.savefig(filename, format='pdf')
+    plt.clf()
+
 
+def hist_sd_rtt(hist, filename, bw):
     '''
     HISTOGRAMS FOR MEAN SD
     '''
-    print("HIST SD...")
-    data = df.mdevRTT
-    bin_widths = [1, 2, 5]
-    for bw in bin_widths:
-        ax = data.hist(bins=range(0, int(max(data))+bw, bw))
-        ax.yaxis.set_major_formatter(FuncFormatter(
-            lambda y, _: '{:.0f}'.format(y/len(data)*100)))
-        plt.xlabel('standard deviation of RTT [ms]')
-        plt.ylabel('Relative Frequency [%]')
-        plt.title(
-            'Histogram for the standard deviation of RTT (bin-width = {})'.format(bw, int(max(data)/bw)))
-        plt.xlim(0, max(data))
-        ticks = range(0, int(max(data))+bw, bw)
-        fs = 8
-        plt.xticks(ticks, rotation=90, fontsize=fs)
-        # ax.xaxis.set_minor_locator(AutoMinorLocator(bw))
-        #ax.grid(which='minor', axis='x', alpha=0.5)
-        ax.grid(which='major', axis='x', alpha=1)
-        # plt.minorticks_on()
-        plt.tight_layout()
-        plt.subplots_adjust(left=0.1, right=0.95, top=0.9, bottom=0.13)
-        plt.savefig(plot_folder+'/SD/hist_sdRTT_bw={}.pdf'.format(bw), format='pdf')
-        plt.clf()
+    print("HIST SD (bin-width = {})...".format(bw))
+    ax = draw_histogram(hist, range(0, int(hist.max)+bw, bw))
+    ax.yaxis.set_major_formatter(FuncFormatter(
+        lambda y, _: '{:.0f}'.format(y/hist.rows*100)))
+    plt.xlabel('standard deviation of RTT [ms]')
+    plt.ylabel('Relative Frequency [%]')
+    plt.title(
+        'Histogram for the standard deviation of RTT (bin-width = {})'.format(bw, int(hist.max/bw)))
+    plt.xlim(0, hist.max)
+    ticks = range(0, int(hist.max)+bw, bw)
+    fs = 8
+    plt.xticks(ticks, rotation=90, fontsize=fs)
+    # ax.xaxis.set_minor_locator(AutoMinorLocator(bw))
+    #ax.grid(which='minor', axis='x', alpha=0.5)
+    ax.grid(which='major', axis='x', alpha=1)
+    # plt.minorticks_on()
+    plt.tight_layout()
+    plt.subplots_adjust(left=0.1, right=0.95, top=0.9, bottom=0.13)
+    plt.savefig(filename, format='pdf')
+    plt.clf()
+
 
+def hist_losses(hist, filename, bw):
     '''
     HISTOGRAMS FOR LOSSESS
     '''
-    print("HIST LOSSES...")
-    data = df.lost
+    print("HIST LOSSES (bin-width = {})...".format(bw))
     # log scale for percentage...disabled :)
-    '''bin_widths = [1, 2, 5, 10]
-    for bw in bin_widths:
-        ax = data.hist(bins=range(0, int(max(data))+bw, bw))
-        ax.yaxis.set_major_formatter(FuncFormatter(lambda y, _: '{:.0f}'.format(y/len(data)*100)))
-        plt.xlabel('Lost packets [%]')
-        plt.ylabel('Relative Frequency [%] (log-scale)')
-        plt.title(
-            'Histogram for the Percentage of Lost Packets (bin-width = {})'.format(bw))
-        plt.xlim(0, 100)
-        plt.yscale('log')
-        ax.xaxis.set_major_locator(MultipleLocator(5))
-        ax.xaxis.set_minor_locator(AutoMinorLocator(1))
-        ax.grid(which='minor', axis='x', alpha=0.5)
-        ax.grid(which='major', axis='x', alpha=1)
-        plt.minorticks_on()
-        plt.tight_layout()
-        plt.subplots_adjust(left=0.1, right=0.97, top=0.9, bottom=0.12)
-        plt.savefig(
-            plot_folder+'/LOSSES/histLOG_losses_bw={}.pdf'.format(bw), format='pdf')
-        plt.clf()'''
-
-    bin_widths = [1, 2, 3, 5]
-    for bw in bin_widths:
-        ax = data.hist(bins=range(0, int(max(data))+bw, bw))
-        ax.yaxis.set_major_formatter(FuncFormatter(
-            lambda y, _: '{:.0f}'.format(y/len(data)*100)))
-        plt.xlabel('Lost packets [%]')
-        plt.ylabel('Relative Frequency [%]')
-        plt.title(
-            'Histogram for the Percentage of Lost Packets (bin-width = {})'.format(bw))
-        plt.xlim(0, 100)
-        ax.xaxis.set_major_locator(MultipleLocator(5))
-        ax.xaxis.set_minor_locator(AutoMinorLocator(1))
-        ax.grid(which='minor', axis='x', alpha=0.5)
-        ax.grid(which='major', axis='x', alpha=1)
-        plt.minorticks_on()
-        plt.tight_layout()
-        plt.subplots_adjust(left=0.1, right=0.97, top=0.9, bottom=0.12)
-        plt.savefig(
-            plot_folder+'/LOSSES/hist_losses_bw={}.pdf'.format(bw), format='pdf')
-        plt.clf()
+    '''ax = data.hist(bins=range(0, int(max(data))+bw, bw))
+    ax.yaxis.set_major_formatter(FuncFormatter(lambda y, _: '{:.0f}'.format(y/len(data)*100)))
+    plt.xlabel('Lost packets [%]')
+    plt.ylabel('Relative Frequency [%] (log-scale)')
+    plt.title(
+        'Histogram for the Percentage of Lost Packets (bin-width = {})'.format(bw))
+    plt.xlim(0, 100)
+    plt.yscale('log')
+    ax.xaxis.set_major_locator(MultipleLocator(5))
+    ax.xaxis.set_minor_locator(AutoMinorLocator(1))
+    ax.grid(which='minor', axis='x', alpha=0.5)
+    ax.grid(which='major', axis='x', alpha=1)
+    plt.minorticks_on()
+    plt.tight_layout()
+    plt.subplots_adjust(left=0.1, right=0.97, top=0.9, bottom=0.12)
+    plt.savefig(
+        plot_folder+'/LOSSES/histLOG_losses_bw={}.pdf'.format(bw), format='pdf')
+    plt.clf()'''
+
+    ax = draw_histogram(hist, range(0, int(hist.max)+bw, bw))
+    ax.yaxis.set_major_formatter(FuncFormatter(
+        lambda y, _: '{:.0f}'.format(y/hist.rows*100)))
+    plt.xlabel('Lost packets [%]')
+    plt.ylabel('Relative Frequency [%]')
+    plt.title(
+        'Histogram for the Percentage of Lost Packets (bin-width = {})'.format(bw))
+    plt.xlim(0, 100)
+    ax.xaxis.set_major_locator(MultipleLocator(5))
+    ax.xaxis.set_minor_locator(AutoMinorLocator(1))
+    ax.grid(which='minor', axis='x', alpha=0.5)
+    ax.grid(which='major', axis='x', alpha=1)
+    plt.minorticks_on()
+    plt.tight_layout()
+    plt.subplots_adjust(left=0.1, right=0.97, top=0.9, bottom=0.12)
+    plt.savefig(filename, format='pdf')
+    plt.clf()
 
 
-def poa_comparison(df, plot_folder):
-    print("Comparison plots for Point-Of-Access...")
+def plot_histograms(key, plot_folder):
+    # each column is counted once in 1-wide bins (all the bin-widths are multiples of 1),
+    # then one job for each histogram, for each bin-width
+    jobs = []
+    for column, start, bin_widths, function, name in [
+            ('avgRTT', 1, [5, 10, 20], hist_mean_rtt, '/RTT/hist_meanRTT_bw={}.pdf'),
+            ('mdevRTT', 0, [1, 2, 5], hist_sd_rtt, '/SD/hist_sdRTT_bw={}.pdf'),
+            ('lost', 0, [1, 2, 3, 5], hist_losses, '/LOSSES/hist_losses_bw={}.pdf')]:
+        hist_key = '{}_hist_v{}'.format(column, key)
+        plot_data[hist_key] = FineHistogram(plot_data[key][column], start, 1)
+        jobs += [(function, hist_key, plot_folder+name.format(bw), (bw,), None) for bw in bin_widths]
+    return jobs
+
+
+# boxplot styles shared by the comparisons
+meanpointprops = dict(marker='_', markeredgecolor='black',
+                      markerfacecolor='firebrick')
+meanlineprops = dict(linestyle='--', linewidth=1.2, color='red')
+flierprops = dict(marker='x', markerfacecolor='black', markersize=5,
+                  linestyle='none')
+# rows drawn by box plots and violins: above this, each group is reduced to its order statistics
+PLOT_POINTS = 50000
+
 
+def bar_poa_mean(df, filename):
+    print("Comparison plots for Point-Of-Access...")
     # 1) BarChart meanRTT 4 poa
     # Filtering data
     dfcasa = df[df['poa'] == 'HOME']
@@ -321,49 +385,34 @@ def poa_comparison(df, plot_folder):
     plt.xlabel("Point of Access")
     plt.xticks(x, ['HOME', 'MOBILE', 'UNIBS', 'OTHER'])
     plt.subplots_adjust(left=0.1, right=0.95, top=0.97, bottom=0.1)
-    plt.savefig(plot_folder+"/meanRTTmeanCOMPARISON.pdf", format='pdf')
+    plt.savefig(filename, format='pdf')
     plt.clf()
 
-    # 2) Boxplot of meanRTT 4 poa
-    meanpointprops = dict(marker='_', markeredgecolor='black',
-                          markerfacecolor='firebrick')
-    meanlineprops = dict(linestyle='--', linewidth=1.2, color='red')
-    flierprops = dict(marker='x', markerfacecolor='black', markersize=5,
-                      linestyle='none')
 
-    ax = sns.boxplot(x=df['poa'], y=df['avgRTT'], showfliers=True,
+def box_poa(df, filename, hue=None, max_points=PLOT_POINTS):
+    # 2) Boxplot of meanRTT 4 poa
+    # 3) Boxplot 4 poa X [ITA, EU, rest of the world] (hue='worldcat') or X CONTINENT (hue='continent')
+    df = thin_groups(df, ['poa', hue] if hue else ['poa'], 'avgRTT', max_points)
+    ax = sns.boxplot(x=df['poa'], y=df['avgRTT'], hue=df[hue] if hue else None, showfliers=True,
                      flierprops=flierprops, showmeans=True, meanline=True, meanprops=meanlineprops)
+    rasterize_dense(ax)
     # plt.setp(ax.get_xticklabels(), rotation=70, fontsize=8)
     plt.xlabel('Point of Access')
     plt.ylabel('RTT distribution [ms]')
     plt.grid()
     ax.set_axisbelow(True)
     # plt.subplots_adjust(left=0.13, right=0.95, top=0.95, bottom=0.23)
-    plt.savefig(plot_folder+"/meanRTT-distribCOMPARISON.pdf", format='pdf')
+    plt.savefig(filename, format='pdf')
     plt.clf()
 
-    # 3) Boxplot 4 poa X [ITA, EU, rest of the world]
-    ax = sns.boxplot(x=df['poa'], y=df['avgRTT'], hue=df['worldcat'], showfliers=True,
-                     flierprops=flierprops, showmeans=True, meanline=True, meanprops=meanlineprops)
-    plt.xlabel('Point of Access')
-    plt.ylabel('RTT distribution [ms]')
-    plt.grid()
-    ax.set_axisbelow(True)
-    # plt.subplots_adjust(left=0.13, right=0.95, top=0.95, bottom=0.23)
-    plt.savefig(
-        plot_folder+"/meanRTT-distribCOMPARISON-by-WORLDCATEGORIES.pdf", format='pdf')
-    plt.clf()
 
-    # 3) Boxplot 4 poa X CONTINENT
-    ax = sns.boxplot(x=df['poa'], y=df['avgRTT'], hue=df['continent'], showfliers=True,
-                     flierprops=flierprops, showmeans=True, meanline=True, meanprops=meanlineprops)
-    plt.xlabel('Point of Access')
-    plt.ylabel('RTT distribution [ms]')
-    plt.grid()
-    ax.set_axisbelow(True)
-    # plt.subplots_adjust(left=0.13, right=0.95, top=0.95, bottom=0.23)
-    plt.savefig(plot_folder+"/meanRTT-distribCOMPARISON-by-CONTINENT.pdf", format='pdf')
-    plt.clf()
+def poa_comparison(key, plot_folder):
+    return [(bar_poa_mean, key, plot_folder+"/meanRTTmeanCOMPARISON.pdf", (), ['poa', 'avgRTT']),
+            (box_poa, key, plot_folder+"/meanRTT-distribCOMPARISON.pdf", (None, PLOT_POINTS), ['poa', 'avgRTT']),
+            (box_poa, key, plot_folder+"/meanRTT-distribCOMPARISON-by-WORLDCATEGORIES.pdf", ('worldcat', PLOT_POINTS),
+             ['poa', 'avgRTT', 'worldcat']),
+            (box_poa, key, plot_folder+"/meanRTT-distribCOMPARISON-by-CONTINENT.pdf", ('continent', PLOT_POINTS),
+             ['poa', 'avgRTT', 'continent'])]
 
 def violin_plot_poa(df, plot_folder):
     print("Violin plots for Point-Of-Access...")
@@ -513,24 +562,159 @@ def violin_plot_operators(df, plot_folder):
 def boxplot_accessTechs(df, plot_folder):
     pass
 
-def plotting(data, plot_folder):
+def find_probe_store(finput, ip_version):
+    # lo store delle singole echo request (autoping.py --probe-store) sta accanto ai risultati
+    folder = finput if os.path.isdir(finput) else (os.path.dirname(finput) or '.')
+    store_folder = os.path.join(folder, 'probes_v{}'.format(ip_version))
+    if not os.path.isfile(os.path.join(store_folder, 'store.json')):
+        return None
+    return ProbeStore(store_folder)
+
+
+def hist_probe_rtt(store, filename):
+    # istogramma calcolato direttamente sulla memory map di tutte le echo request
+    probes = store.probes()
+    print("HIST ALL PROBES... ({} echo requests)".format(len(probes)))
+    lost = probes['lost'].astype(bool)
+    rtt = probes['rtt'][~lost]
+    if len(rtt):
+        counts, edges = np.histogram(rtt, bins=np.arange(0, float(np.percentile(rtt, 99)) + 5, 5))
+        plt.stairs(counts / len(rtt) * 100, edges, fill=True)
+        plt.xlabel('RTT of the single echo requests [ms]')
+        plt.ylabel('Relative Frequency [%]')
+        plt.title('Histogram of the RTT of all the echo requests (bin-width = 5)')
+        plt.tight_layout()
+        plt.savefig(filename, format='pdf')
+        plt.clf()
 
-    # plot_folder specifica in quale cartella vanno salvati i plot, in base alla versione di IP.
 
-    plt.rc('axes', axisbelow=True)
-    plt.figure(figsize=(9, 4.5))
+def hist_jitter(stats, filename):
+    print("HIST JITTER...")
+    jitter = stats['jitter'].dropna()
+    if len(jitter):
+        jitter.hist(bins=np.arange(0, jitter.max() + 1, 1))
+        plt.xlabel('Jitter (mean difference between consecutive RTTs) [ms]')
+        plt.ylabel('Number of targets')
+        plt.title('Histogram of the jitter of each target (bin-width = 1)')
+        plt.tight_layout()
+        plt.savefig(filename, format='pdf')
+        plt.clf()
+
+
+def hist_loss_burst(stats, filename):
+    print("HIST LOSS BURSTS...")
+    bursts = stats['maxLossBurst']
+    if len(bursts):
+        counts = np.bincount(bursts.astype(int))
+        plt.bar(range(len(counts)), counts)
+        plt.xlabel('Longest run of consecutive lost echo requests')
+        plt.ylabel('Number of targets')
+        plt.title('Longest loss burst of each target')
+        plt.tight_layout()
+        plt.savefig(filename, format='pdf')
+        plt.clf()
+
+
+def plot_probe_store(store, ip_version, plot_folder):
+    # lo store (memory map) e le statistiche per target si condividono con i processi come i risultati
+    plot_data['store_v{}'.format(ip_version)] = store
+    plot_data['probe_stats_v{}'.format(ip_version)] = store.target_stats()
+    store_key, stats_key = 'store_v{}'.format(ip_version), 'probe_stats_v{}'.format(ip_version)
+    return [(hist_probe_rtt, store_key, plot_folder+'/RTT/hist_probeRTT_bw=5.pdf', (), None),
+            (hist_jitter, stats_key, plot_folder+'/SD/hist_jitter_bw=1.pdf', (), ['jitter']),
+            (hist_loss_burst, stats_key, plot_folder+'/LOSSES/hist_lossBurst.pdf', (), ['maxLossBurst'])]
+
+
+def plotting(key, plot_folder):
+
+    # plot_folder specifica in quale cartella vanno salvati i plot, in base alla versione di IP.
+    # Ogni plot è un job (funzione, chiave dei dati in plot_data, file, argomenti, colonne usate)
+    # che disegna una sola figura: i job vengono poi eseguiti in parallelo da render_all.
 
     # histograms of all RTT stats
-    plot_histograms(data, plot_folder)
+    jobs = plot_histograms(key, plot_folder)
 
     # boxplot per punto-di-accesso e operator
-    poa_comparison(data, plot_folder)
+    jobs += poa_comparison(key, plot_folder)
 
-    boxplot_accessTechs(data, plot_folder)
+    boxplot_accessTechs(plot_data[key], plot_folder)
 
     #violin_plot_poa(data, violin_plot_poa)
 
     #violin_plot_operators(data, violin_plot_poa)
+    return jobs
+
+
+"""
+The validated data of all the plots (one DataFrame for each IP version, the probe stores...)
+is kept in plot_data, by key: with fork the processes of the pool inherit it from the main
+process, otherwise the initializer receives it once per process. Jobs only carry the key.
+"""
+plot_data = {}
+
+
+def init_renderer(data):
+    global plot_data
+    if data is not None:
+        plot_data = data
+    plt.rc('axes', axisbelow=True)
+
+
+def render(job):
+    function, key, filename, args, columns = job
+    plt.figure(figsize=(9, 4.5))
+    function(plot_data[key], filename, *args)
+    plt.close('all')
+
+
+def drawing_code():
+    # the code a figure depends on is hashed as a whole: the plot functions with their helpers
+    # and constants (draw_histogram, PLOT_POINTS, flierprops...) and the reductions of util/aggregate.py
+    modules = [sys.modules[render.__module__], sys.modules[thin_groups.__module__]]
+    return cache_key(*[inspect.getsource(module) for module in modules])
+
+
+def plot_key(job, code):
+    # everything a figure depends on: the code drawing it, its parameters and the data it uses
+    function, key, filename, args, columns = job
+    data = plot_data[key]
+    if hasattr(data, 'signature'):
+        # probe store, pre-aggregated histogram
+        content = data.signature()
+    else:
+        content = cache_key(pd.util.hash_pandas_object(data[columns], index=False).to_numpy().tobytes())
+    return cache_key(code, function.__name__, key, args, columns, content, matplotlib.__version__, sns.__version__)
+
+
+def render_all(jobs, workers=None, cache=None):
+    # con la cache si disegnano solo le figure nuove o cambiate, le altre si copiano dalla cache
+    keys = [None] * len(jobs)
+    if cache is not None:
+        code = drawing_code()
+        keys = [plot_key(job, code) for job in jobs]
+        todo = [(job, key) for job, key in zip(jobs, keys) if not cache.fetch(key, job[2])]
+        print("{} plots unchanged, restored from the cache".format(len(jobs) - len(todo)))
+        jobs, keys = [job for job, key in todo], [key for job, key in todo]
+
+    if workers == 1 or len(jobs) <= 1:
+        init_renderer(None)
+        for job, key in zip(jobs, keys):
+            render(job)
+            if cache is not None:
+                cache.store(key, job[2])
+    else:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context, data = multiprocessing.get_context('fork'), None
+        else:
+            context, data = multiprocessing.get_context(), plot_data
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=init_renderer, initargs=(data,)) as executor:
+            for job, key, result in zip(jobs, keys, executor.map(render, jobs)):
+                if cache is not None:
+                    cache.store(key, job[2])
+    if cache is not None:
+        cache.save()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,46 @@
+from .commons import *
+import math
+from statistics import NormalDist
+
+'''
+Adaptive probe count: instead of always sending --numping echo requests, a target is probed
+until the confidence interval of its mean RTT is narrower than a given width.
+The mean and the variance are updated at each reply with Welford's algorithm, so the check
+costs the same at the first and at the last probe. Lost probes count against the budget but
+do not contribute to the estimate.
+'''
+
+
+class StoppingRule:
+    def __init__(self, ci_width, min_probes=10, confidence=0.95):
+        # ci_width: full width (ms) of the confidence interval of the mean RTT
+        # (the maximum number of echo requests is the count of the ping, --numping)
+        self.ci_width = ci_width
+        self.min_probes = min_probes
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    def estimate(self):
+        return RttEstimate(self)
+
+
+class RttEstimate:
+    def __init__(self, rule):
+        self.rule = rule
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, rtt):
+        self.n += 1
+        delta = rtt - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (rtt - self.mean)
+
+    def ci_width(self):
+        if self.n < 2:
+            return float('inf')
+        return 2 * self.rule.z * math.sqrt(self.m2 / (self.n - 1) / self.n)
+
+    def converged(self, probes):
+        # probes: echo requests sent so far, replies included
+        return probes >= self.rule.min_probes and self.ci_width() <= self.rule.ci_width
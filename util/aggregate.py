@@ -0,0 +1,92 @@
+import hashlib
+import numpy as np
+import pandas as pd
+
+'''
+Reduction of the results before plotting, so that drawing time and PDF size do not grow
+with the number of rows:
+ - FineHistogram counts a column once in narrow bins; the histograms with coarser bin
+   widths are sums of adjacent bins (the same counts np.histogram would give on the data)
+ - thin_groups keeps, for each group, evenly spaced order statistics of the values, as many
+   as the share of the group in the rows: quantiles (box plots) and density (violins) of
+   the reduced data differ from the real ones by at most one step of the kept order
+   statistics, minimum and maximum are kept, and the groups keep their relative weight,
+   so any union of groups (e.g. a hue merged away) is still a faithful sample
+ - rasterize_dense turns layers with many markers into images inside the vector PDF
+'''
+
+
+class FineHistogram:
+    def __init__(self, values, start=0, width=1):
+        values = np.asarray(values, dtype=np.float64)
+        # rows, NaN included: the relative frequencies of the plots are computed on all the rows
+        self.rows = len(values)
+        values = values[~np.isnan(values)]
+        self.max = values.max() if len(values) else np.nan
+        self.start = start
+        self.width = width
+        position = (values - start) / width
+        position = position[position >= 0]
+        index = np.floor(position).astype(np.int64)
+        self.counts = np.bincount(index)
+        # values that are exactly on an edge: the last bin of a histogram is closed on the right
+        self.on_edge = np.bincount(index[position == index], minlength=len(self.counts))
+
+    def coarse(self, bins):
+        # bins: edges as for np.histogram, evenly spaced by a multiple of width, from start
+        edges = np.asarray(bins, dtype=np.float64)
+        ratio = int(round((edges[1] - edges[0]) / self.width))
+        first = int(round((edges[0] - self.start) / self.width))
+        num_bins = len(edges) - 1
+        fine = np.arange(len(self.counts)) - first
+        inside = (fine >= 0) & (fine < num_bins * ratio)
+        counts = np.bincount(fine[inside] // ratio, weights=self.counts[inside], minlength=num_bins)
+        last_edge = first + num_bins * ratio
+        if 0 <= last_edge < len(self.on_edge):
+            counts[-1] += self.on_edge[last_edge]
+        return counts
+
+    def signature(self):
+        digest = hashlib.sha256(self.counts.tobytes())
+        digest.update(self.on_edge.tobytes())
+        # max sets the range of the bins, the limits and the ticks of the plots
+        return [self.rows, float(self.max), self.start, self.width, digest.hexdigest()]
+
+
+def thin_sorted(values, points):
+    # evenly spaced order statistics (minimum and maximum included)
+    values = np.sort(values[~np.isnan(values)])
+    if len(values) <= points:
+        return values
+    return values[np.linspace(0, len(values) - 1, points).round().astype(np.int64)]
+
+
+def thin_groups(df, by, column, max_points=50000):
+    # the values of column, reduced to about max_points rows in total, split among the groups of by
+    if len(df) <= max_points:
+        return df[by + [column]]
+    fraction = max_points / len(df)
+    parts = []
+    for group, values in df.groupby(by, observed=True, sort=False)[column]:
+        points = max(int(round(len(values) * fraction)), min(len(values), 2))
+        thinned = thin_sorted(values.to_numpy(dtype=np.float64), points)
+        group = group if isinstance(group, tuple) else (group,)
+        part = pd.DataFrame({c: np.repeat(np.array([g], dtype=object), len(thinned)) for c, g in zip(by, group)})
+        part[column] = thinned
+        parts.append(part)
+    reduced = pd.concat(parts, ignore_index=True)
+    for c in by:
+        # the same categories (and order) of the original columns
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            reduced[c] = pd.Categorical(reduced[c], categories=df[c].cat.categories)
+    return reduced
+
+
+def rasterize_dense(ax, min_points=1000):
+    # markers and lines with many points are drawn as an image, the rest stays vector
+    for artist in ax.collections:
+        if len(artist.get_offsets()) >= min_points:
+            artist.set_rasterized(True)
+    for line in ax.lines:
+        if len(line.get_xdata()) >= min_points:
+            line.set_rasterized(True)
@@ -34,6 +34,8 @@ class Pingable:
         self.countryCode = countryCode
         self.more = more
         self.qdn = qdn
+        # log of the most recent measurement of this target
+        self.last_log = None
 
     def __str__(self):
         return "{}--> {}\t({})".format(self.ip.ljust(16), self.qdn.ljust(26), self.countryCode)
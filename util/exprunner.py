@@ -1,36 +1,21 @@
 from .commons import *
-import urllib.request
-import subprocess
+import asyncio
+import signal
 import threading
-from subprocess import TimeoutExpired
-import concurrent.futures
+from time import time, monotonic
 import progressbar
+from .icmpengine import IcmpEngine, write_ping_log
+from .samples import ProbeRecord, PingOutputParser
+from .logarchive import ArchiveWriter
+from .pacing import ProbeScheduler
+from .ipapi import IpApiClient, BATCH_SIZE
+from .resolver import resolve_qdns, normalize_address
 
-queryParams = "?fields=status,message,continent,continentCode,country,countryCode,"\
-    "region,regionName,city,zip,lat,lon,timezone,isp,org,as,query,reverse"
+# righe validate nel primo blocco di --pipeline, prima che parta il primo ping
+PIPELINE_FIRST_CHUNK = 2
 
 
-def ipapi_query(query, slow=False):
-    if slow:
-        # Max Rate 45queries/minute ==> Freq = 0.75 Hz ==> Periodo = 1.33
-        # Going slower than 1 query every 1.33 sec is enough to not exceed the max rate
-        sleep(1.34)
-    ask = "http://ip-api.com/json/"+query+queryParams
-    try:
-        resp = urllib.request.urlopen(ask)
-    except urllib.error.HTTPError:
-        print("""Without a pro service, ip-api.com tolerates up to 45 queries per minute.
-            Please, retry autoping.py after having waited for a while.""")
-        exit()
-    except Exception as e:
-        print("""ip-api.com is not replying as expected.
-            Problems with your Internet Connection?""")
-        exit()
-    data = json.load(resp)
-    return data
-
-
-def is_slowing_needed(lines):
+def get_valid_lines(lines):
     validLines = []
     for index, line in enumerate(lines):
         index += 1
@@ -41,100 +26,172 @@ def is_slowing_needed(lines):
             continue
         validLines.append((index, line))
     # qui abbiamo solo le righe che contengono qualche info da validare
-    flag = True # le queries saranno molto probabilmente più di 45 al minuto
-    if flag:
-        print("SLOWING DOWN QUERIES")
-    return validLines, flag
+    return validLines
 
 
-def validate_ip_list(iplistfile):
+def parse_ip_line(index, line, iplistfile):
+    elems = line.split(',')
+    elems = [e.strip() for e in elems]
+    if len(elems) != 3:
+        print("Line {}: {} is NOT VALID".format(index, line))
+        return None
+    try:
+        qdn = QDNregex.match(elems[0]).group()
+        IPv4 = IPv4regex.match(elems[1]).group()
+        IPv6 = IPv6regex.match(elems[2]).group()
+    except:
+        print("Not a valid sequence of QDN, IP on line {} of {}".format(
+            index, iplistfile))
+        print("Please, correct this line: {}".format(line))
+        return None
+    return elems, qdn, IPv4, IPv6
+
+
+def read_candidates(iplistfile):
+    with open(iplistfile, 'r') as f:
+        validLines = get_valid_lines(f.readlines())
+
+    candidates = []
+    for index, line in validLines:
+        parsed = parse_ip_line(index, line, iplistfile)
+        if parsed:
+            candidates.append((index, line) + parsed)
+    return candidates
+
+
+def iter_valid_pairs(candidates, iplistfile, client=None, resolver=None, chunk_size=BATCH_SIZE, pbar=None,
+                     first_chunk=None, journal=None):
+    # Le righe vengono validate a blocchi: ogni coppia (IPv4, IPv6) valida viene restituita
+    # appena il suo blocco e' stato verificato, senza attendere il resto della lista.
+    # Con first_chunk il primo blocco e' piu' piccolo e i successivi raddoppiano fino a chunk_size,
+    # cosi' la prima coppia e' pronta dopo poche righe senza moltiplicare le richieste a ip-api.com
+    if client is None:
+        client = IpApiClient()
+    try:
+        start, size = 0, first_chunk or chunk_size
+        while start < len(candidates):
+            chunk = candidates[start:start+size]
+
+            # Tutte le QDN vengono risolte localmente e in parallelo (record A e AAAA),
+            # per verificare che gli indirizzi indicati appartengano davvero alla QDN
+            records = resolve_qdns([elems[0] for index, line, elems, qdn, IPv4, IPv6 in chunk], resolver)
+
+            # Le interrogazioni a ip-api.com (geolocalizzazione di IPv4 e IPv6)
+            # vengono raccolte e risolte con una richiesta batch
+            queries = []
+            for index, line, elems, qdn, IPv4, IPv6 in chunk:
+                queries += [elems[1], elems[2]]
+            answers = client.batch(queries)
+
+            for i, (index, line, elems, qdn, IPv4, IPv6) in enumerate(chunk):
+                print("Validating line {}: {}".format(str(index).rjust(2, ' '), line))
+                if pbar is not None:
+                    pbar.update(start+i)
+                pair = validate_pair(index, line, elems, qdn, IPv4, IPv6, records[elems[0]],
+                                     answers[2*i], answers[2*i+1], iplistfile)
+                if journal is not None:
+                    # la riga e' validata (con i suoi target, se valida): con --resume non viene ripetuta
+                    journal.add_validated(index, pair)
+                if pair:
+                    yield pair
+            start += len(chunk)
+            size = min(2 * size, chunk_size)
+    finally:
+        client.close()
+
+
+def validate_pair(index, line, elems, qdn, IPv4, IPv6, records, data_v4, data_v6, iplistfile):
+    records_v4, records_v6 = records
+
+    if not records_v4 and not records_v6:
+        print("DNS has not been able to resolve this QDN: {}".format(qdn))
+        return None
+
+    if data_v4['status'] != 'success':
+        print("ip-api.com has not been able to resolve this IPv4: {}".format(IPv4))
+        return None
+
+    check_v4 = normalize_address(IPv4) in records_v4
+    check_v6 = False
+    if not check_v4:
+        print("Line {} of {}: IPv4 address mismatches QDN".format(index, iplistfile))
+        print("Please, correct this line: {}".format(line))
+        print("NB: DNS tells that {} --> {}".format(qdn, ", ".join(sorted(records_v4)) or "no A records"))
+    else:
+        check_v6 = True
+        if data_v6['status'] != 'success':
+            print("ip-api.com has not been able to resolve this IPv6: {}".format(IPv6))
+            return None
+
+        #Controlliamo che l'IPv4 e l'IPv6 considerati provengano per lo meno dalla stessa regione.
+        #Abbiamo deciso di affidarci a questo stratagemma per evitare errori dovuti alla molteplicità
+        #di indirizzi IPv6 legati al medesimo sito locati in regioni differenti rispetto all'IPv4.
+        #Se l'IPv6 compare tra i record AAAA della QDN, l'appartenenza e' gia' dimostrata.
+        if normalize_address(IPv6) not in records_v6 and data_v6['regionName'] != data_v4['regionName']:
+            check_v6 = False
+            print("IPv4 and IPv6 are not located in the same region.")
+
+    if not check_v4 or not check_v6:
+        print("Line {}: {} is NOT VALID".format(index, line))
+        return None
+
+    pingable_v4 = Pingable(data_v4['query'], data_v4['reverse'], data_v4['countryCode'], data_v4, qdn=qdn)
+    pingable_v6 = Pingable(data_v6['query'], data_v6['reverse'], data_v6['countryCode'], data_v6, qdn=qdn)
+    return pingable_v4, pingable_v6
+
+
+def validate_remaining_lines(journal, client=None, resolver=None):
+    # --resume di una campagna interrotta durante la validazione: le righe candidate
+    # non ancora validate vengono validate ora e i loro target aggiunti al journal
+    remaining = journal.unvalidated()
+    if not remaining:
+        return
+    print("Validating the {} lines of {} not validated before the interruption".format(
+        len(remaining), journal.iplistfile))
+    candidates = []
+    for index, line in remaining:
+        parsed = parse_ip_line(index, line, journal.iplistfile)
+        if parsed:
+            candidates.append((index, line) + parsed)
+    try:
+        for pair in iter_valid_pairs(candidates, journal.iplistfile, client, resolver, journal=journal):
+            pass
+    except Exception as e:
+        print_ipapi_error(e)
+
+
+def print_ipapi_error(e):
+    print(e)
+    print("""ip-api.com is not replying as expected.
+            Problems with your Internet Connection?""")
+
+
+def validate_ip_list(iplistfile, client=None, resolver=None, journal=None):
     print('\n# BUILDING LIST OF PING COMMANDS TO BE EXECUTED'.ljust(60, '-'))
     print("Scanning IPlist.csv to validate IP addresses and QDNs...")
-    
-    # Numero di volte in cui si verifica se IPv4 e IP di QDN coincidono (nel caso in cui una QDN sia associata a piu' IPv4)
-    n_prove = 5
 
     pingable_list_v4 = []
     pingable_list_v6 = []
 
-    with open(iplistfile, 'r') as f:
-        lines = f.readlines()
-        validLines, slowFlag = is_slowing_needed(lines)
-        pbar = progressbar.ProgressBar(max_value=len(validLines), redirect_stdout=True)
-        pbar.start()
-        for i, l in enumerate(validLines):
-            line = l[1]
-            index = l[0]
-            elems = line.split(',')
-            elems = [e.strip() for e in elems]
-            print("Validating line {}: {}".format(str(index).rjust(2, ' '), line))
-            
-            if len(elems) == 3:
-                try:
-                    qdn = QDNregex.match(elems[0]).group()
-                    IPv4 = IPv4regex.match(elems[1]).group()
-                    IPv6 = IPv6regex.match(elems[2]).group()
-                except:
-                    print("Not a valid sequence of QDN, IP on line {} of {}".format(
-                        index, iplistfile))
-                    print("Please, correct this line: {}".format(line))
-                    continue
-
-                data_QDN = ipapi_query(elems[0], slowFlag)
-                if data_QDN['status'] != 'success':
-                    print("ip-api.com has not been able to resolve this QDN: {}".format(qdn))
-                    break
-
-                check_v4 = False
-                data_v4 = ipapi_query(elems[1], slowFlag)
-                if data_v4['status'] != 'success':
-                    print("ip-api.com has not been able to resolve this IPv4: {}".format(IPv4))
-                    break
-                for i in range(1, n_prove):
-                    data_QDN = ipapi_query(elems[0], slowFlag)
-                    if IPv4 != data_QDN['query']:
-                        continue
-                    else:
-                        check_v4 = True
-                        break
-
-                if not check_v4:
-                    print("Line {} of {}: IPv4 address mismatches QDN".format(index, iplistfile))
-                    print("Please, correct this line: {}".format(line))
-                    print("NB: ip-api.com tells that {} --> {}".format(qdn, data_v4['query']))
-                else:
-                    check_v6 = True
-                    data_v6 = ipapi_query(elems[2], slowFlag)
-                    if data_v6['status'] != 'success':
-                        print("ip-api.com has not been able to resolve this IPv6: {}".format(IPv6))
-                        break
-
-                    #Controlliamo che l'IPv4 e l'IPv6 considerati provengano per lo meno dalla stessa regione.
-                    #Abbiamo deciso di affidarci a questo stratagemma per evitare errori dovuti alla molteplicità
-                    #di indirizzi IPv6 legati al medesimo sito locati in regioni differenti rispetto all'IPv4.
-                    if data_v6['regionName'] != data_v4['regionName']:
-                        check_v6 = False
-                        print("IPv4 and IPv6 are not located in the same region.")
-                
-                if not check_v4 or not check_v6:
-                    print("Line {}: {} is NOT VALID".format(index, line))
-                    continue
-            
-            else:
-                print("Line {}: {} is NOT VALID".format(index, line))
-                continue
-            
-            if check_v4 and check_v6:
-                pingable_v4 = Pingable(data_v4['query'], data_v4['reverse'], data_v4['countryCode'], data_v4, qdn=qdn)
-                pingable_list_v4.append(pingable_v4)
-                pingable_v6 = Pingable(data_v6['query'], data_v6['reverse'], data_v6['countryCode'], data_v6, qdn=qdn)
-                pingable_list_v6.append(pingable_v6)
-            pbar.update(i)
-        pbar.finish()
+    candidates = read_candidates(iplistfile)
+    if journal is not None:
+        # come con --pipeline: se la validazione viene interrotta, --resume valida le righe mancanti
+        journal.add_candidates(candidates, iplistfile)
+
+    pbar = progressbar.ProgressBar(max_value=len(candidates), redirect_stdout=True)
+    pbar.start()
+    try:
+        for pingable_v4, pingable_v6 in iter_valid_pairs(candidates, iplistfile, client, resolver, pbar=pbar,
+                                                         journal=journal):
+            pingable_list_v4.append(pingable_v4)
+            pingable_list_v6.append(pingable_v6)
+    except Exception as e:
+        print_ipapi_error(e)
+        exit()
+    pbar.finish()
 
 
     print("\nFound #{} valid IP that will be pinged:".format(len(pingable_list_v4)))
-    pingable_list_v4[0].ip 
     for i in range(len(pingable_list_v4)):
         print("  IPv4: {}   IPv6: {}   QDN: {}   [{}]".format(pingable_list_v4[i].ip.ljust(16), pingable_list_v6[i].ip.ljust(40), 
             pingable_list_v4[i].qdn.ljust(30), pingable_list_v6[i].countryCode))
@@ -150,13 +207,13 @@ def build_out_dir(outfolder='out'):
     return outfolder
 
 
-def build_ping_args(IPaddress, howmany, OS, ip_version):
+def build_ping_args(IPaddress, howmany, OS, ip_version, interval=1):
     command = "ping"
 
     ip_version_option = "-4" if ip_version == 4 else "-6"
 
     if OS == "posix":
-        countarg, bytesizearg, numbytes, intervalarg, definterval = "-c", "-s", "56", "-i", "1"
+        countarg, bytesizearg, numbytes, intervalarg, definterval = "-c", "-s", "56", "-i", str(interval)
     elif OS == "nt":
         countarg, bytesizearg, numbytes, intervalarg, definterval = "-n", "-l", "64", "-w", "1"
     return [command, IPaddress, countarg, howmany, bytesizearg, numbytes, intervalarg, definterval, ip_version_option]
@@ -171,50 +228,365 @@ def build_log_name(outdir, config, pingable):
     elems += [pingable.nickname(), pingable.countryCode, formattedTime]
     return "_".join(elems)+".txt"
 
-def ping(args, logname, timeout):
-    #random sleep to avoid perfect synchronization
-    sleep(random())
-    with open(logname, 'w') as log:
-        pingproc = subprocess.Popen(args, stdout=log)
+async def ping(args, logname, timeout, OS, scheduler=None, rule=None):
+    # l'output di ping viene letto riga per riga mentre arriva: ogni riga finisce nel log
+    # e le singole risposte vengono raccolte nel record dei campioni
+    parser = PingOutputParser(OS, rule.estimate() if rule is not None else None)
+    with open(logname, 'wb') as log:
+        pingproc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE)
         try:
-            stdout, stderr = pingproc.communicate(timeout=timeout)
-        except TimeoutExpired as te:
-            pingproc.terminate()
-            return te
+            await asyncio.wait_for(stream_output(pingproc, log, parser), timeout=timeout)
+        except asyncio.TimeoutError:
+            await terminate(pingproc)
+            return "TIMEOUT after {}s".format(timeout)
+        except asyncio.CancelledError:
+            await terminate(pingproc)
+            raise
         except Exception as e:
-            pingproc.terminate()
+            await terminate(pingproc)
             return e
+        finally:
+            record = parser.close()
+            record.save(logname)
+            if scheduler is not None:
+                scheduler.account(len(record))
+    return "OK"
+
+
+async def stream_output(pingproc, log, parser):
+    stopped = False
+    async for line in pingproc.stdout:
+        log.write(line)
+        parser.feed(line.decode(errors='replace'))
+        if parser.estimate is not None and not stopped and parser.estimate.converged(len(parser.record)):
+            # con SIGINT ping smette di inviare echo request ma stampa comunque
+            # le statistiche finali, che finiscono nel log come sempre
+            stopped = True
+            pingproc.send_signal(signal.SIGINT)
+    await pingproc.wait()
+
+
+async def terminate(pingproc):
+    if pingproc.returncode is None:
+        try:
+            pingproc.terminate()
+        except ProcessLookupError:
+            pass
+    await pingproc.wait()
+
+
+async def native_ping(engine, pingable, howmany, logname, timeout, ip_version, interval, rule=None):
+    target = await engine.probe(pingable.ip, ip_version, int(howmany), interval=interval, timeout=timeout,
+                                estimate=rule.estimate() if rule is not None else None)
+    write_ping_log(logname, target, ip_version)
+    # gli istanti di invio sono misurati con il clock monotono: vengono riportati al tempo epoch
+    to_epoch = time() - monotonic()
+    times = [target.sent[seq] + to_epoch for seq in range(1, target.transmitted+1)]
+    ProbeRecord.from_rtts(target.rtts[:target.transmitted], times).save(logname)
+    if engine.scheduler is not None:
+        engine.scheduler.account(target.transmitted)
+    if target.transmitted < int(howmany) and not target.converged:
+        return "TIMEOUT after {}s".format(timeout)
     return "OK"
 
-def run_ping_measurments(ping_list, howmany, config, OS, num_cpu, ip_version):
 
+async def run_job(job, timeout, engine, OS, scheduler, interval, offset=0, journal=None):
+    pingable, args, logname, rule = job
+    await asyncio.sleep(offset)
+    if journal is not None:
+        journal.update(pingable, 'running', logname)
+    if engine is not None:
+        howmany, ip_version = args
+        result = await native_ping(engine, pingable, howmany, logname, timeout, ip_version, interval, rule)
+    else:
+        if scheduler is not None:
+            # il processo ping parte solo quando il bucket globale lo consente,
+            # cosi' le echo request dei vari processi restano sfasate tra loro
+            await scheduler.acquire(pingable.ip)
+        result = await ping(args, logname, timeout, OS, scheduler, rule)
+    if journal is not None:
+        # un ping interrotto (es. CTRL+C) resta 'running' e verra' ripetuto con --resume
+        journal.update(pingable, 'done' if result == "OK" else 'failed', logname, result)
+    return pingable, result
+
+
+async def ping_group(group, timeout, slots, start_delay, engine, OS, scheduler, interval, journal=None):
+    # la concorrenza e' limitata dal semaforo condiviso: i ping di un gruppo
+    # vengono lanciati solo quando si libera uno slot
+    async with slots:
+        # il primo gruppo di ping viene distribuito lungo 1 secondo, per evitare
+        # che tutti i figli mandino le echo request in perfetta sincronia
+        await asyncio.sleep(start_delay)
+        # i job dello stesso gruppo (es. IPv4 e IPv6 di una QDN) sono misurati nella
+        # stessa finestra temporale, sfasati di mezzo intervallo tra un'echo request e l'altra
+        offsets = [k * interval / len(group) for k in range(len(group))]
+        return await asyncio.gather(*[run_job(job, timeout, engine, OS, scheduler, interval, offset, journal)
+                                      for job, offset in zip(group, offsets)])
+
+
+async def ping_all(groups, num_slots, timeout, pbar, OS, native=False, scheduler=None, interval=1,
+                   journal=None, archives=None):
+    # Un solo event loop supervisiona tutti i processi ping figli
+    # (oppure, con il motore nativo, tutti i socket ICMP)
+    slots = asyncio.Semaphore(num_slots)
+    engine = IcmpEngine(scheduler=scheduler) if native else None
+    tasks = []
+    for i, group in enumerate(groups):
+        # con lo scheduler sono i token bucket a distribuire le partenze
+        start_delay = i * interval / num_slots if i < num_slots and scheduler is None else 0
+        tasks.append(asyncio.ensure_future(
+            ping_group(group, timeout, slots, start_delay, engine, OS, scheduler, interval, journal)))
+
+    results = {}
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            for pingable, result in await next_done:
+                results[pingable] = result
+                archive_log(archives, pingable)
+                print('Finished to ping: {}, Result: {}'.format(pingable, result))
+            pbar.update(len(results))
+    finally:
+        # in caso di interruzione (es. CTRL+C) tutti i ping ancora attivi vengono terminati
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if engine is not None:
+            engine.close()
+    return results
+
+
+def open_archives(archive, *outdirs):
+    # con archive=True ogni log viene spostato nei segmenti della sua cartella appena
+    # il ping termina, invece di restare li' come file separato
+    return {outdir: ArchiveWriter(outdir) for outdir in outdirs} if archive else None
+
+
+def close_archives(archives):
+    for writer in (archives or {}).values():
+        writer.close()
+
+
+def archive_log(archives, pingable):
+    writer = (archives or {}).get(os.path.dirname(pingable.last_log))
+    if writer is not None:
+        writer.add(pingable.last_log)
+        writer.sync()
+
+
+def build_job(pingable, outdir, howmany, config, OS, ip_version, engine, interval=1, rule=None):
+    # rule: StoppingRule del numero adattivo di echo request (None: se ne inviano sempre howmany)
+    logname = build_log_name(outdir, config, pingable)
+    pingable.last_log = logname
+    if engine == 'native':
+        args = (howmany, ip_version)
+    else:
+        args = build_ping_args(pingable.ip, howmany, OS, ip_version, interval)
+    return pingable, args, logname, rule
+
+
+def build_jobs(ping_list, howmany, config, OS, ip_version, engine, interval=1, rule=None):
     # Creiamo due cartelle out, una per misurazioni con IPv4 ed una per misurazioni con IPv6
     outdir = build_out_dir(outfolder="out_v4") if ip_version == 4 else build_out_dir(outfolder="out_v6")
-    
-    # timeout 50% in piu' del numero di pacchetti inviati
+    jobs = [build_job(pingable, outdir, howmany, config, OS, ip_version, engine, interval, rule)
+            for pingable in ping_list]
+    return outdir, jobs
+
+
+def print_engine(engine, num_parallel):
+    if engine == 'native':
+        print("PERFORMING NATIVE ICMP ECHO PROBES...(up to {} targets in parallel)".format(num_parallel))
+    else:
+        print("PERFORMING PING COMMANDS...(up to {} in parallel)".format(num_parallel))
+
+
+def build_scheduler(max_rate, dest_rate, engine='system'):
+    if not max_rate and not dest_rate:
+        return None, 1
+    scheduler = ProbeScheduler(max_rate, dest_rate)
+    # una destinazione non riceve mai piu' di dest_rate echo request al secondo
+    interval = 1 / dest_rate if dest_rate else 1
+    if engine == 'system':
+        # sotto 1 secondo di intervallo il comando ping richiederebbe privilegi di root
+        interval = max(1, interval)
+    print("Pacing probes: max {} probes/s overall, max {} probes/s per destination".format(
+        max_rate or "unlimited", dest_rate or "unlimited"))
+    return scheduler, interval
+
+
+def campaign_slots(num_parallel, scheduler, interval, engine, group_size=1):
+    num_slots = max(num_parallel // group_size, 1)
+    if scheduler is not None:
+        # con il ping di sistema si puo' limitare solo il numero di processi attivi insieme;
+        # con il motore nativo ogni echo request e' cadenzata, ma i target attivi insieme sono
+        # limitati allo stesso modo: con piu' target di quanti il limite globale ne sostenga a
+        # 1/interval echo request al secondo, il bucket rallenterebbe ogni ping oltre il suo timeout
+        num_slots = scheduler.max_concurrent_pings(num_slots, interval / group_size)
+    return num_slots
+
+
+def run_ping_measurments(ping_list, howmany, config, OS, num_parallel, ip_version, engine='system',
+                         max_rate=None, dest_rate=None, journal=None, rule=None, archive=False):
+    scheduler, interval = build_scheduler(max_rate, dest_rate, engine)
+    outdir, jobs = build_jobs(ping_list, howmany, config, OS, ip_version, engine, interval, rule)
+    archives = open_archives(archive, outdir)
+
+    # timeout 50% in piu' della durata prevista del ping
     num_icmp_req = int(howmany)
-    timeout = num_icmp_req * 1.5
+    timeout = num_icmp_req * interval * 1.5
 
-    print("PERFORMING PING COMMANDS...(in {} parallel subprocesses)".format(num_cpu))
+    print_engine(engine, num_parallel)
 
-    pbar = progressbar.ProgressBar(max_value=len(ping_list), redirect_stdout=True)
+    pbar = progressbar.ProgressBar(max_value=len(jobs), redirect_stdout=True)
     pbar.start()
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=num_cpu) as executor:
-        futures = {}
-        results = {}
-        for pingable in ping_list:
-            logname = build_log_name(outdir, config, pingable)
-            args = build_ping_args(pingable.ip, howmany, OS, ip_version)
-            fut = executor.submit(ping, args, logname, timeout)
-            futures[fut] = pingable
-
-        for future in concurrent.futures.as_completed(futures):
-            arg = futures[future]
-            results[arg] = future.result()
-            print('Finished to ping: {}, Result: {}'.format(arg, results[arg]))
+    groups = [[job] for job in jobs]
+    num_slots = campaign_slots(num_parallel, scheduler, interval, engine)
+    try:
+        asyncio.run(ping_all(groups, num_slots, timeout, pbar, OS, native=(engine == 'native'),
+                             scheduler=scheduler, interval=interval, journal=journal, archives=archives))
+    finally:
+        close_archives(archives)
+
+    pbar.finish()
+    if scheduler is not None:
+        scheduler.report()
+
+    return outdir
+
+
+def run_paired_ping_measurments(ping_list_v4, ping_list_v6, howmany, config, OS, num_parallel, engine='system',
+                                max_rate=None, dest_rate=None, journal=None, rule=None, archive=False):
+    # IPv4 e IPv6 della stessa QDN vengono misurati in contemporanea, con echo request
+    # alternate tra le due famiglie, condividendo lo stesso limite di ping in parallelo
+    scheduler, interval = build_scheduler(max_rate, dest_rate, engine)
+    outdir_v4, jobs_v4 = build_jobs(ping_list_v4, howmany, config, OS, 4, engine, interval, rule)
+    outdir_v6, jobs_v6 = build_jobs(ping_list_v6, howmany, config, OS, 6, engine, interval, rule)
+    archives = open_archives(archive, outdir_v4, outdir_v6)
+
+    # timeout 50% in piu' della durata prevista del ping
+    num_icmp_req = int(howmany)
+    timeout = num_icmp_req * interval * 1.5
+
+    print_engine(engine, num_parallel)
+    print("IPv4 and IPv6 addresses of each QDN are pinged in the same time window")
+
+    pbar = progressbar.ProgressBar(max_value=len(jobs_v4)+len(jobs_v6), redirect_stdout=True)
+    pbar.start()
+
+    groups = [[job_v4, job_v6] for job_v4, job_v6 in zip(jobs_v4, jobs_v6)]
+    num_slots = campaign_slots(num_parallel, scheduler, interval, engine, group_size=2)
+    try:
+        asyncio.run(ping_all(groups, num_slots, timeout, pbar, OS, native=(engine == 'native'),
+                             scheduler=scheduler, interval=interval, journal=journal, archives=archives))
+    finally:
+        close_archives(archives)
+
+    pbar.finish()
+    if scheduler is not None:
+        scheduler.report()
+
+    return outdir_v4, outdir_v6
+
+
+async def ping_pipeline(pairs, to_groups, num_slots, queue_size, timeout, pbar, OS, native=False,
+                        scheduler=None, interval=1, journal=None, archives=None):
+    # Produttore/consumatori: le coppie validate finiscono in una coda limitata e vengono
+    # misurate subito dai worker. Se la misura e' in ritardo la coda si riempie e la
+    # validazione si ferma (backpressure) finche' non si libera un posto.
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    failures = []
+
+    def produce():
+        # la validazione e' bloccante (DNS, HTTP): gira in un thread separato
+        try:
+            for pair in pairs:
+                for group in to_groups(pair):
+                    asyncio.run_coroutine_threadsafe(queue.put(group), loop).result()
+        except Exception as e:
+            failures.append(e)
+        finally:
+            for i in range(num_slots):
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+    slots = asyncio.Semaphore(num_slots)
+    engine = IcmpEngine(scheduler=scheduler) if native else None
+    results = {}
+
+    async def worker(start_delay):
+        while True:
+            group = await queue.get()
+            if group is None:
+                return
+            for pingable, result in await ping_group(group, timeout, slots, start_delay, engine, OS,
+                                                     scheduler, interval, journal):
+                results[pingable] = result
+                archive_log(archives, pingable)
+                print('Finished to ping: {}, Result: {}'.format(pingable, result))
             pbar.update(len(results))
-    
+            start_delay = 0
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    workers = [asyncio.ensure_future(worker(0 if scheduler else k * interval / num_slots))
+               for k in range(num_slots)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if engine is not None:
+            engine.close()
+    return results, failures
+
+
+def run_pipelined_measurments(iplistfile, howmany, config, OS, num_parallel, engine='system', paired=False,
+                              max_rate=None, dest_rate=None, client=None, resolver=None, journal=None,
+                              rule=None, archive=False):
+    # Validazione e misura si sovrappongono: ogni coppia IPv4/IPv6 viene pingata
+    # appena il suo blocco di righe di IPlist.txt e' stato validato
+    print('\n# VALIDATING AND PINGING TARGETS AS A PIPELINE'.ljust(60, '-'))
+    candidates = read_candidates(iplistfile)
+    if journal is not None:
+        # le righe candidate sono registrate subito: con --resume quelle non ancora
+        # validate al momento dell'interruzione vengono validate di nuovo
+        journal.add_candidates(candidates, iplistfile)
+    pairs = iter_valid_pairs(candidates, iplistfile, client, resolver, first_chunk=PIPELINE_FIRST_CHUNK,
+                             journal=journal)
+
+    scheduler, interval = build_scheduler(max_rate, dest_rate, engine)
+    outdir_v4 = build_out_dir(outfolder="out_v4")
+    outdir_v6 = build_out_dir(outfolder="out_v6")
+    archives = open_archives(archive, outdir_v4, outdir_v6)
+
+    def to_groups(pair):
+        job_v4 = build_job(pair[0], outdir_v4, howmany, config, OS, 4, engine, interval, rule)
+        job_v6 = build_job(pair[1], outdir_v6, howmany, config, OS, 6, engine, interval, rule)
+        return [[job_v4, job_v6]] if paired else [[job_v4], [job_v6]]
+
+    # timeout 50% in piu' della durata prevista del ping
+    num_icmp_req = int(howmany)
+    timeout = num_icmp_req * interval * 1.5
+
+    print_engine(engine, num_parallel)
+    group_size = 2 if paired else 1
+    num_slots = campaign_slots(num_parallel, scheduler, interval, engine, group_size=group_size)
+
+    pbar = progressbar.ProgressBar(max_value=progressbar.UnknownLength, redirect_stdout=True)
+    pbar.start()
+    try:
+        results, failures = asyncio.run(ping_pipeline(pairs, to_groups, num_slots, num_slots, timeout, pbar, OS,
+                                                      native=(engine == 'native'), scheduler=scheduler,
+                                                      interval=interval, journal=journal, archives=archives))
+    finally:
+        close_archives(archives)
     pbar.finish()
 
-    return outdir
\ No newline at end of file
+    if failures:
+        print_ipapi_error(failures[0])
+        print("Only the {} targets validated before the error have been pinged".format(len(results)))
+    if scheduler is not None:
+        scheduler.report()
+
+    return outdir_v4, outdir_v6
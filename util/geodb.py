@@ -0,0 +1,183 @@
+from .commons import *
+import csv
+import ipaddress
+
+'''
+Offline geolocation/ASN lookups.
+A local dataset maps network prefixes (e.g. 151.99.0.0/16, 2a00:1450::/32) to the same fields
+returned by ip-api.com (countryCode, regionName, city, lat, lon, as, ...).
+It can be a CSV file with a "network" column plus any of those fields, or the compact .npz
+produced by GeoDatabase.save(), which loads without parsing a single address.
+
+Longest-prefix match: for every prefix length there is a sorted array of prefix keys, and the
+lengths are tried from the longest to the shortest. Each step is a vectorized searchsorted
+over all the addresses being looked up, so bulk lookups cost microseconds per address.
+IPv6 keys use the upper 64 bits of the address; the rare prefixes longer than /64 are kept
+in a plain dict.
+'''
+
+FIELDS = ['continent', 'continentCode', 'country', 'countryCode', 'region', 'regionName',
+          'city', 'zip', 'lat', 'lon', 'timezone', 'isp', 'org', 'as']
+FLOAT_FIELDS = ['lat', 'lon']
+U64 = np.uint64
+
+
+def split_address(address):
+    # returns the IP version and the address as (upper 64 bits, lower 64 bits)
+    ip = ipaddress.ip_address(address.split('%')[0])
+    value = int(ip)
+    return ip.version, value >> 64, value & 0xFFFFFFFFFFFFFFFF
+
+
+def shift_right(values, shift):
+    if shift >= 64:
+        return np.zeros(len(values), dtype=U64)
+    return values >> U64(shift)
+
+
+class PrefixIndex:
+    def __init__(self, version, words, lengths, ids):
+        # words: the part of each prefix used as key (IPv4: 32 bits, IPv6: upper 64 bits)
+        self.version = version
+        self.width = 32 if version == 4 else 64
+        self.tables = []
+        self.long_prefixes = {}
+        for length in sorted(set(lengths.tolist()), reverse=True):
+            selected = lengths == length
+            if length > self.width:
+                continue
+            keys = shift_right(words[selected], self.width - length)
+            order = np.argsort(keys, kind='stable')
+            keys, sel_ids = keys[order], ids[selected][order]
+            # with duplicated prefixes the last record of the dataset wins
+            last = np.append(keys[1:] != keys[:-1], True)
+            self.tables.append((length, keys[last], sel_ids[last]))
+
+    def add_long_prefix(self, length, key, record_id):
+        self.long_prefixes.setdefault(length, {})[key] = record_id
+
+    def lookup(self, words, full_values=None):
+        found = np.full(len(words), -1, dtype=np.int64)
+        if full_values is not None and self.long_prefixes:
+            for i, value in enumerate(full_values):
+                for length in sorted(self.long_prefixes, reverse=True):
+                    record_id = self.long_prefixes[length].get(value >> (128 - length))
+                    if record_id is not None:
+                        found[i] = record_id
+                        break
+        for length, keys, ids in self.tables:
+            todo = found < 0
+            if not todo.any():
+                break
+            wanted = shift_right(words[todo], self.width - length)
+            pos = np.searchsorted(keys, wanted)
+            pos[pos == len(keys)] = 0
+            hit = keys[pos] == wanted if len(keys) else np.zeros(len(wanted), dtype=bool)
+            idx = np.flatnonzero(todo)[hit]
+            found[idx] = ids[pos[hit]]
+        return found
+
+
+class GeoDatabase:
+    def __init__(self, version, net_hi, net_lo, lengths, columns):
+        self.version = version
+        self.net_hi = net_hi
+        self.net_lo = net_lo
+        self.lengths = lengths
+        self.columns = columns
+        ids = np.arange(len(lengths), dtype=np.int64)
+        v4, v6 = version == 4, version == 6
+        self.index = {4: PrefixIndex(4, net_lo[v4], lengths[v4], ids[v4]),
+                      6: PrefixIndex(6, net_hi[v6], lengths[v6], ids[v6])}
+        for i in np.flatnonzero(v6 & (lengths > 64)):
+            value = (int(net_hi[i]) << 64) | int(net_lo[i])
+            self.index[6].add_long_prefix(int(lengths[i]), value >> (128 - int(lengths[i])), int(i))
+
+    @classmethod
+    def load(cls, filename):
+        if filename.endswith('.npz'):
+            with np.load(filename) as data:
+                columns = {f: data[f] for f in FIELDS if f in data}
+                return cls(data['version'], data['net_hi'], data['net_lo'], data['length'], columns)
+        return cls.from_csv(filename)
+
+    @classmethod
+    def from_csv(cls, filename):
+        version, net_hi, net_lo, lengths = [], [], [], []
+        columns = {f: [] for f in FIELDS}
+        with open(filename, newline='') as f:
+            for row in csv.DictReader(f):
+                try:
+                    network = ipaddress.ip_network(row['network'].strip(), strict=False)
+                except (KeyError, ValueError):
+                    raise Exception("{}: cannot parse the network of row {}".format(filename, row))
+                value = int(network.network_address)
+                version.append(network.version)
+                net_hi.append(value >> 64)
+                net_lo.append(value & 0xFFFFFFFFFFFFFFFF)
+                lengths.append(network.prefixlen)
+                for field in FIELDS:
+                    columns[field].append((row.get(field) or '').strip())
+        for field in FLOAT_FIELDS:
+            columns[field] = np.array([float(v) if v else np.nan for v in columns[field]])
+        columns = {f: np.array(v) for f, v in columns.items()}
+        return cls(np.array(version, dtype=np.uint8), np.array(net_hi, dtype=U64),
+                   np.array(net_lo, dtype=U64), np.array(lengths, dtype=np.uint8), columns)
+
+    def save(self, filename):
+        np.savez_compressed(filename, version=self.version, net_hi=self.net_hi, net_lo=self.net_lo,
+                            length=self.lengths, **self.columns)
+
+    def lookup_ids(self, addresses):
+        # record id of the longest matching prefix of each address, -1 if none matches
+        found = np.full(len(addresses), -1, dtype=np.int64)
+        split = {4: [], 6: []}
+        for i, address in enumerate(addresses):
+            try:
+                version, hi, lo = split_address(address)
+            except ValueError:
+                continue
+            split[version].append((i, hi, lo))
+        for version, items in split.items():
+            if not items:
+                continue
+            positions = np.array([i for i, hi, lo in items])
+            if version == 4:
+                found[positions] = self.index[4].lookup(np.array([lo for i, hi, lo in items], dtype=U64))
+            else:
+                words = np.array([hi for i, hi, lo in items], dtype=U64)
+                full_values = [(hi << 64) | lo for i, hi, lo in items]
+                found[positions] = self.index[6].lookup(words, full_values)
+        return found
+
+    def record(self, record_id, address):
+        if record_id < 0:
+            return {'status': 'fail', 'message': 'not found in the offline database', 'query': address}
+        data = {'status': 'success', 'query': address, 'reverse': ''}
+        for field, values in self.columns.items():
+            value = values[record_id]
+            data[field] = float(value) if field in FLOAT_FIELDS else str(value)
+        return data
+
+    # Same interface of IpApiClient, so that it can replace it in validate_ip_list
+    def batch(self, queries):
+        return [self.record(int(i), q) for i, q in zip(self.lookup_ids(queries), queries)]
+
+    def query(self, query):
+        return self.batch([query])[0]
+
+    def close(self):
+        pass
+
+
+def open_geodb(filename):
+    # a CSV dataset is converted once to the compact .npz format, saved next to it
+    if filename.endswith('.npz'):
+        return GeoDatabase.load(filename)
+    cache = os.path.splitext(filename)[0] + '.npz'
+    if os.path.isfile(cache) and os.path.getmtime(cache) >= os.path.getmtime(filename):
+        return GeoDatabase.load(cache)
+    print("Indexing the offline geolocation database {}...".format(filename))
+    db = GeoDatabase.from_csv(filename)
+    db.save(cache)
+    return db
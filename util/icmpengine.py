@@ -0,0 +1,208 @@
+from .commons import *
+import asyncio
+import math
+import socket
+import struct
+from time import monotonic
+
+'''
+In-process ICMP/ICMPv6 echo engine.
+All the echo requests of a campaign are multiplexed over a few sockets per address family:
+unprivileged datagram ICMP sockets are used when the OS allows them, raw sockets otherwise.
+Replies are matched to their target thanks to a token carried in the echo payload,
+and timestamped with a monotonic clock as soon as they are read from the socket.
+'''
+
+ICMP_ECHO_REQUEST = {4: 8, 6: 128}
+ICMP_ECHO_REPLY = {4: 0, 6: 129}
+ICMP_HEADER = struct.Struct("!BBHHH")
+PAYLOAD_HEADER = struct.Struct("!II")
+PAYLOAD_SIZE = 56
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def open_icmp_socket(ip_version):
+    family = socket.AF_INET if ip_version == 4 else socket.AF_INET6
+    proto = socket.IPPROTO_ICMP if ip_version == 4 else socket.IPPROTO_ICMPV6
+    try:
+        # datagram ICMP socket: no privileges needed (Linux ping_group_range, macOS)
+        sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+        raw = False
+    except OSError:
+        try:
+            sock = socket.socket(family, socket.SOCK_RAW, proto)
+            raw = True
+        except OSError:
+            raise Exception("Cannot open an ICMPv{} socket: check net.ipv4.ping_group_range "
+                            "or run autoping with enough privileges".format(ip_version))
+    sock.setblocking(False)
+    return sock, raw
+
+
+class EchoTarget:
+    def __init__(self, token, address, count, estimate=None):
+        self.token = token
+        self.address = address
+        self.count = count
+        self.estimate = estimate
+        self.converged = False
+        self.sent = {}
+        # rtts[seq-1] is NaN until the reply to seq arrives
+        self.rtts = [float('NaN')] * count
+        self.received = 0
+        self.transmitted = 0
+        self.elapsed = 0.0
+        self.completed = asyncio.Event()
+
+    def reply(self, seq, when):
+        if seq not in self.sent or not math.isnan(self.rtts[seq-1]):
+            # unknown or duplicate reply
+            return
+        self.rtts[seq-1] = (when - self.sent[seq]) * 1000
+        self.received += 1
+        if self.estimate is not None:
+            self.estimate.add(self.rtts[seq-1])
+        if self.received == self.transmitted == self.count:
+            self.completed.set()
+
+
+class IcmpEngine:
+    def __init__(self, sockets_per_family=1, payload_size=PAYLOAD_SIZE, scheduler=None):
+        self.sockets_per_family = sockets_per_family
+        self.scheduler = scheduler
+        self.payload_size = max(payload_size, PAYLOAD_HEADER.size)
+        self.sockets = {4: [], 6: []}
+        self.targets = {}
+        self.next_token = 1
+        self.identifier = os.getpid() & 0xFFFF
+
+    def socket_for(self, ip_version, token):
+        sockets = self.sockets[ip_version]
+        if len(sockets) < self.sockets_per_family:
+            sock, raw = open_icmp_socket(ip_version)
+            asyncio.get_running_loop().add_reader(sock.fileno(), self.on_readable, sock, raw, ip_version)
+            sockets.append((sock, raw))
+        return sockets[token % len(sockets)]
+
+    def close(self):
+        loop = asyncio.get_running_loop()
+        for ip_version in self.sockets:
+            for sock, raw in self.sockets[ip_version]:
+                loop.remove_reader(sock.fileno())
+                sock.close()
+            self.sockets[ip_version] = []
+
+    def build_packet(self, ip_version, token, seq):
+        payload = PAYLOAD_HEADER.pack(token, seq).ljust(self.payload_size, b'\x00')
+        header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST[ip_version], 0, 0, self.identifier, seq)
+        if ip_version == 4:
+            # per ICMPv6 il checksum viene calcolato dal kernel
+            header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST[ip_version], 0,
+                                      checksum(header + payload), self.identifier, seq)
+        return header + payload
+
+    def on_readable(self, sock, raw, ip_version):
+        while True:
+            try:
+                data = sock.recv(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # es. ICMP errors notified on the socket: nothing to match
+                continue
+            when = monotonic()
+            if ip_version == 4 and data and data[0] >> 4 == 4:
+                # raw sockets (and macOS datagram sockets) also return the IPv4 header
+                data = data[(data[0] & 0x0F) * 4:]
+            if len(data) < ICMP_HEADER.size + PAYLOAD_HEADER.size:
+                continue
+            icmp_type, code, _, identifier, seq = ICMP_HEADER.unpack_from(data)
+            if icmp_type != ICMP_ECHO_REPLY[ip_version]:
+                continue
+            # sui socket datagram l'identifier viene riscritto dal kernel
+            if raw and identifier != self.identifier:
+                continue
+            token, payload_seq = PAYLOAD_HEADER.unpack_from(data, ICMP_HEADER.size)
+            target = self.targets.get(token)
+            if target is None or payload_seq != seq:
+                continue
+            target.reply(seq, when)
+
+    async def probe(self, address, ip_version, count, interval=1.0, timeout=None, linger=2.0, estimate=None):
+        token = self.next_token
+        self.next_token += 1
+        target = EchoTarget(token, address, count, estimate)
+        self.targets[token] = target
+        sock, raw = self.socket_for(ip_version, token)
+        start = monotonic()
+        deadline = start + timeout if timeout else float('inf')
+        try:
+            for seq in range(1, count+1):
+                # echo requests are scheduled on a fixed grid, so that
+                # a late wakeup does not shift all the following probes
+                delay = start + (seq-1)*interval - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.scheduler is not None:
+                    await self.scheduler.acquire(address)
+                if monotonic() > deadline:
+                    break
+                if estimate is not None and estimate.converged(target.transmitted):
+                    # la stima dell'RTT e' gia' abbastanza precisa: niente altre echo request
+                    target.converged = True
+                    target.count = target.transmitted
+                    break
+                packet = self.build_packet(ip_version, token, seq & 0xFFFF)
+                target.sent[seq] = monotonic()
+                target.transmitted += 1
+                try:
+                    sock.sendto(packet, (address, 0))
+                except OSError:
+                    # e.g. network unreachable: the probe is counted as lost
+                    pass
+            target.elapsed = (monotonic() - start) * 1000
+            if target.received < target.transmitted:
+                # attendiamo le ultime risposte, senza superare il timeout
+                wait = min(linger, max(deadline - monotonic(), 0))
+                try:
+                    await asyncio.wait_for(target.completed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            del self.targets[token]
+        return target
+
+
+def write_ping_log(logname, target, ip_version, payload_size=PAYLOAD_SIZE):
+    # Il log imita l'output di iputils ping, cosi' postprocess lo analizza senza modifiche
+    address = target.address
+    with open(logname, 'w') as log:
+        if ip_version == 4:
+            log.write("PING {} ({}) {}({}) bytes of data.\n".format(address, address, payload_size, payload_size+28))
+        else:
+            log.write("PING {}({}) {} data bytes\n".format(address, address, payload_size))
+        for seq in range(1, target.transmitted+1):
+            rtt = target.rtts[seq-1]
+            if not math.isnan(rtt):
+                log.write("{} bytes from {}: icmp_seq={} time={:.3f} ms\n".format(
+                    payload_size+8, address, seq, rtt))
+        log.write("\n--- {} ping statistics ---\n".format(address))
+        TX, RX = target.transmitted, target.received
+        lost = round((1 - RX/TX) * 100) if TX else 100
+        log.write("{} packets transmitted, {} received, {}% packet loss, time {}ms\n".format(
+            TX, RX, lost, int(target.elapsed)))
+        rtts = [r for r in target.rtts[:TX] if not math.isnan(r)]
+        if rtts:
+            mean = sum(rtts) / len(rtts)
+            # mdev come in iputils: sqrt(E[x^2] - E[x]^2)
+            mdev = math.sqrt(max(sum(r*r for r in rtts) / len(rtts) - mean*mean, 0))
+            log.write("rtt min/avg/max/mdev = {:.3f}/{:.3f}/{:.3f}/{:.3f} ms\n".format(
+                min(rtts), mean, max(rtts), mdev))
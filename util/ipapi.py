@@ -0,0 +1,89 @@
+from .commons import *
+import http.client
+from time import monotonic
+
+'''
+Client for ip-api.com.
+A single HTTP connection is kept open and reused for all the lookups, and many addresses/QDNs
+are resolved with each request through the batch endpoint (up to 100 queries per request).
+The free service limits the number of requests per minute: instead of sleeping before every
+request, the client reads the remaining quota (X-Rl) and the seconds to its reset (X-Ttl)
+from each response and waits only when the quota is exhausted.
+'''
+
+FIELDS = "status,message,continent,continentCode,country,countryCode,"\
+    "region,regionName,city,zip,lat,lon,timezone,isp,org,as,query,reverse"
+BATCH_SIZE = 100
+
+
+class IpApiClient:
+    def __init__(self, host="ip-api.com", port=80, fields=FIELDS, timeout=15):
+        self.host = host
+        self.port = port
+        self.fields = fields
+        self.timeout = timeout
+        self.connection = None
+        # rate-limit accounting, one entry per endpoint: (remaining requests, monotonic time of reset)
+        self.quota = {}
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def wait_quota(self, endpoint):
+        if endpoint not in self.quota:
+            return
+        remaining, reset = self.quota[endpoint]
+        wait = reset - monotonic()
+        if remaining <= 0 and wait > 0:
+            print("ip-api.com rate limit reached: waiting {:.0f}s".format(wait))
+            sleep(wait)
+
+    def update_quota(self, endpoint, response):
+        remaining, ttl = response.getheader('X-Rl'), response.getheader('X-Ttl')
+        if remaining is not None and ttl is not None:
+            self.quota[endpoint] = (int(remaining), monotonic() + int(ttl) + 1)
+
+    def request(self, endpoint, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in range(3):
+            self.wait_quota(endpoint)
+            try:
+                connection = self.connect()
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                payload = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # the server closed the kept-alive connection: open a new one and retry
+                self.close()
+                continue
+            except OSError as e:
+                self.close()
+                raise Exception("ip-api.com is not replying as expected ({})".format(e))
+            self.update_quota(endpoint, response)
+            if response.status == 429:
+                # quota exhausted anyway (e.g. shared with other clients): wait for the reset
+                self.quota[endpoint] = (0, self.quota.get(endpoint, (0, monotonic() + 60))[1])
+                continue
+            if response.status != 200:
+                raise Exception("ip-api.com replied with HTTP {} {}".format(response.status, response.reason))
+            return json.loads(payload)
+        raise Exception("ip-api.com is not replying as expected")
+
+    def query(self, query):
+        return self.request('json', 'GET', "/json/{}?fields={}".format(query, self.fields))
+
+    def batch(self, queries):
+        # results are returned in the same order of the queries
+        results = []
+        for i in range(0, len(queries), BATCH_SIZE):
+            chunk = queries[i:i+BATCH_SIZE]
+            results += self.request('batch', 'POST', "/batch?fields={}".format(self.fields),
+                                    body=json.dumps(chunk))
+        return results
@@ -0,0 +1,176 @@
+from .commons import *
+from .samples import samples_name
+from .logarchive import open_archive, ArchiveWriter
+import ipaddress
+import threading
+
+'''
+Campaign journal, used to resume an interrupted campaign with --resume.
+It is an append-only file with one JSON event per line: the campaign parameters, the validated
+targets and every change of state of a target (pending -> running -> done|failed).
+With --pipeline the candidate lines of the IP list are recorded first, and each line once it
+has been validated, so that the lines not validated yet are validated again on resume.
+Each event is appended with a single write followed by fsync, so an interruption can at most
+truncate the last line, which is ignored when the journal is loaded.
+'''
+
+JOURNAL_FILE = 'campaign_journal.jsonl'
+
+
+def pingable_to_dict(pingable):
+    return {'ip': pingable.ip, 'fqdn': pingable.fqdn, 'countryCode': pingable.countryCode,
+            'more': pingable.more, 'qdn': pingable.qdn}
+
+
+def pingable_from_dict(data):
+    return Pingable(data['ip'], data['fqdn'], data['countryCode'], data['more'], qdn=data['qdn'])
+
+
+def target_key(pingable, ip_version=None):
+    # the same address can be listed for more QDNs: each (ip_version, ip, qdn) is a target of its own
+    if ip_version is None:
+        ip_version = ipaddress.ip_address(pingable.ip.split('%')[0]).version
+    return [ip_version, pingable.ip, pingable.qdn]
+
+
+def event_key(event):
+    # JSON has no tuples: the key is saved as a list
+    key = event['key']
+    return tuple(key) if isinstance(key, list) else key
+
+
+class CampaignJournal:
+    def __init__(self, filename, config, howmany):
+        self.filename = filename
+        self.config = config
+        self.howmany = howmany
+        # key (ip_version, IP address, QDN) --> {'ip_version', 'pingable', 'state', 'logname', 'result'}
+        self.targets = {}
+        # --pipeline: line number --> line of the IP list, and the line numbers already validated
+        self.iplistfile = None
+        self.candidates = {}
+        self.validated = set()
+        self.fd = None
+        # with --pipeline the targets are added by the validation thread
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, config, howmany, filename=JOURNAL_FILE):
+        journal = cls(filename, config, howmany)
+        journal.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        journal.append({'event': 'campaign', 'config': config, 'howmany': howmany})
+        return journal
+
+    @classmethod
+    def load(cls, filename=JOURNAL_FILE):
+        if not os.path.isfile(filename):
+            raise Exception("Cannot resume: {} not found".format(filename))
+        journal = None
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if not data.endswith(b'\n'):
+            # the last event was truncated by the interruption: it is dropped,
+            # so that the next events are appended on a new line
+            os.truncate(filename, data.rfind(b'\n') + 1)
+        for line in data.decode().splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event['event'] == 'campaign':
+                journal = cls(filename, event['config'], event['howmany'])
+            elif journal is not None:
+                journal.replay(event)
+        if journal is None:
+            raise Exception("Cannot resume: {} is not a campaign journal".format(filename))
+        journal.fd = os.open(filename, os.O_WRONLY | os.O_APPEND)
+        return journal
+
+    def append(self, event):
+        with self.lock:
+            os.write(self.fd, (json.dumps(event) + '\n').encode())
+            os.fsync(self.fd)
+
+    def replay(self, event):
+        if event['event'] == 'candidates':
+            self.iplistfile = event['iplistfile']
+            self.candidates = {index: line for index, line in event['lines']}
+        elif event['event'] == 'validated':
+            self.validated.add(event['line'])
+        elif event['event'] == 'target':
+            if event.get('line') is not None:
+                self.validated.add(event['line'])
+            self.targets[event_key(event)] = {'ip_version': event['ip_version'],
+                                              'pingable': pingable_from_dict(event['pingable']),
+                                              'state': 'pending', 'logname': None, 'result': None}
+        elif event['event'] == 'state' and event_key(event) in self.targets:
+            entry = self.targets[event_key(event)]
+            entry['state'] = event['state']
+            entry['logname'] = event['logname']
+            entry['result'] = event['result']
+
+    def add_targets(self, ping_list, ip_version, line=None):
+        # line: the line of the IP list the targets come from (--pipeline)
+        for pingable in ping_list:
+            event = {'event': 'target', 'key': target_key(pingable, ip_version), 'ip_version': ip_version,
+                     'pingable': pingable_to_dict(pingable), 'line': line}
+            self.append(event)
+            self.replay(event)
+
+    def add_candidates(self, candidates, iplistfile):
+        event = {'event': 'candidates', 'iplistfile': iplistfile,
+                 'lines': [[candidate[0], candidate[1]] for candidate in candidates]}
+        self.append(event)
+        self.replay(event)
+
+    def add_validated(self, index, pair):
+        # pair: the (IPv4, IPv6) targets of a valid line, None for a line that is not valid
+        if pair:
+            self.add_targets([pair[0]], 4, index)
+            self.add_targets([pair[1]], 6, index)
+        else:
+            event = {'event': 'validated', 'line': index}
+            self.append(event)
+            self.replay(event)
+
+    def unvalidated(self):
+        return [(index, line) for index, line in sorted(self.candidates.items()) if index not in self.validated]
+
+    def update(self, pingable, state, logname=None, result=None):
+        event = {'event': 'state', 'key': target_key(pingable), 'state': state,
+                 'logname': logname, 'result': None if result is None else str(result)}
+        self.append(event)
+        self.replay(event)
+
+    def count(self, state):
+        return len([e for e in self.targets.values() if e['state'] == state])
+
+    def unfinished(self, ip_version):
+        # targets to be pinged again; the partial logs they left behind are removed,
+        # so that the new measurement does not produce a duplicate log
+        ping_list = []
+        archived = {}
+        for entry in self.targets.values():
+            if entry['ip_version'] != ip_version or entry['state'] == 'done':
+                continue
+            logname = entry['logname']
+            for filename in [logname, logname and samples_name(logname)]:
+                if not filename:
+                    continue
+                if os.path.isfile(filename):
+                    os.remove(filename)
+                elif os.path.basename(filename) in open_archive(os.path.dirname(filename)):
+                    archived.setdefault(os.path.dirname(filename), []).append(os.path.basename(filename))
+            ping_list.append(entry['pingable'])
+        # logs already moved into an archive are removed with a tombstone
+        for folder, names in archived.items():
+            writer = ArchiveWriter(folder)
+            for name in names:
+                writer.remove(name)
+            writer.close()
+        return ping_list
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
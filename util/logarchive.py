@@ -0,0 +1,206 @@
+from .commons import *
+from glob import glob
+import struct
+import zlib
+
+'''
+Segmented, compressed archive of ping logs, replacing thousands of small files in out_v4/out_v6.
+The folder holds append-only segment files (segment-NNNNN.plog): each record is a log
+(or the .npy samples of a log) compressed on its own, so any of them can be read with a
+single seek. When a segment is closed, an index of its records (name, offset, length) is
+appended to it, followed by a fixed-size footer pointing to the index. A segment that was
+not closed (e.g. the campaign was killed) is still readable: its records are scanned.
+
+An archived log keeps its usual path, folder + name, as if the file was still there:
+read_log/open_archive resolve it, so parse_file_name and the error messages do not change.
+A later record with the same name replaces the earlier one; a tombstone removes it.
+'''
+
+SEGMENT_MAGIC = b'PLOGSEG1'
+RECORD_HEADER = struct.Struct('<4sBHI')   # magic, kind, length of the name, length of the data
+RECORD_MAGIC = b'PREC'
+FOOTER = struct.Struct('<QI8s')           # offset and length of the index, magic
+FOOTER_MAGIC = b'PLOGIDX1'
+DATA, TOMBSTONE = 0, 1
+SEGMENT_SIZE = 64 * 1024 * 1024
+# preset dictionary: the lines every log is made of compress well even in short logs
+ZDICT = b"PING  56(84) bytes of data.\n64 bytes from : icmp_seq= ttl= time= ms\n" \
+        b"--- ping statistics ---\n packets transmitted,  received, % packet loss, time ms\n" \
+        b"rtt min/avg/max/mdev = / / / ms\n"
+
+
+def compress(data):
+    compressor = zlib.compressobj(6, zdict=ZDICT)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data):
+    decompressor = zlib.decompressobj(zdict=ZDICT)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def segment_files(folder):
+    return sorted(glob(os.path.join(folder, 'segment-*.plog')))
+
+
+def read_segment_index(segment):
+    # returns the records of a segment: [(name, kind, offset, length)]
+    with open(segment, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= len(SEGMENT_MAGIC) + FOOTER.size:
+            f.seek(size - FOOTER.size)
+            index_offset, index_length, magic = FOOTER.unpack(f.read(FOOTER.size))
+            if magic == FOOTER_MAGIC:
+                f.seek(index_offset)
+                return [tuple(r) for r in json.loads(zlib.decompress(f.read(index_length)))]
+        return scan_segment(f, size)
+
+
+def scan_segment(f, size):
+    records = []
+    f.seek(len(SEGMENT_MAGIC))
+    while f.tell() + RECORD_HEADER.size <= size:
+        magic, kind, name_length, length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        if magic != RECORD_MAGIC:
+            break
+        name = f.read(name_length).decode()
+        offset = f.tell()
+        if offset + length > size:
+            # record truncated by an interruption
+            break
+        records.append((name, kind, offset, length))
+        f.seek(offset + length)
+    return records
+
+
+class LogArchive:
+    '''Read access to the archive of a folder: name --> (segment, offset, length)'''
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.entries = {}
+        self.state = archive_state(folder)
+        for segment in segment_files(folder):
+            for name, kind, offset, length in read_segment_index(segment):
+                if kind == TOMBSTONE:
+                    self.entries.pop(name, None)
+                else:
+                    self.entries[name] = (segment, offset, length)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self, extension='.txt'):
+        return sorted(n for n in self.entries if n.endswith(extension))
+
+    def read(self, name):
+        segment, offset, length = self.entries[name]
+        with open(segment, 'rb') as f:
+            f.seek(offset)
+            return decompress(f.read(length))
+
+    def signature(self, name):
+        segment, offset, length = self.entries[name]
+        return [length, os.path.basename(segment), offset]
+
+
+def archive_state(folder):
+    return [(s, os.path.getsize(s)) for s in segment_files(folder)]
+
+
+# archives already opened by this process, reloaded only when their segments change
+_archives = {}
+
+
+def open_archive(folder):
+    folder = folder or '.'
+    archive = _archives.get(folder)
+    if archive is None or archive.state != archive_state(folder):
+        archive = _archives[folder] = LogArchive(folder)
+    return archive
+
+
+def read_log(path):
+    # contents of a log, either a plain file or a record of the archive of its folder
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    archive = open_archive(os.path.dirname(path))
+    name = os.path.basename(path)
+    if name not in archive:
+        raise Exception("{} not found".format(path))
+    return archive.read(name)
+
+
+class ArchiveWriter:
+    '''Appends logs to a new segment of the archive of a folder'''
+
+    def __init__(self, folder, segment_size=SEGMENT_SIZE):
+        self.folder = folder
+        self.segment_size = segment_size
+        self.file = None
+        self.records = []
+        # files already copied in the archive, removed once the archive is on disk
+        self.archived_files = []
+
+    def open_segment(self):
+        segments = segment_files(self.folder)
+        number = int(segments[-1][-10:-5]) + 1 if segments else 1
+        self.segment = os.path.join(self.folder, 'segment-{:05d}.plog'.format(number))
+        self.file = open(self.segment, 'xb')
+        self.file.write(SEGMENT_MAGIC)
+        self.records = []
+
+    def append(self, name, kind, data):
+        if self.file is None:
+            self.open_segment()
+        encoded = name.encode()
+        self.file.write(RECORD_HEADER.pack(RECORD_MAGIC, kind, len(encoded), len(data)))
+        self.file.write(encoded)
+        self.records.append((name, kind, self.file.tell(), len(data)))
+        self.file.write(data)
+        if self.file.tell() >= self.segment_size:
+            self.seal()
+
+    def add(self, path):
+        # the log and its samples (if any) are moved into the archive
+        for filename in [path, os.path.splitext(path)[0] + '.npy']:
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    self.append(os.path.basename(filename), DATA, compress(f.read()))
+                self.archived_files.append(filename)
+
+    def remove(self, name):
+        self.append(name, TOMBSTONE, b'')
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        for filename in self.archived_files:
+            os.remove(filename)
+        self.archived_files = []
+
+    def seal(self):
+        index = zlib.compress(json.dumps(self.records).encode())
+        index_offset = self.file.tell()
+        self.file.write(index)
+        self.file.write(FOOTER.pack(index_offset, len(index), FOOTER_MAGIC))
+        self.sync()
+        self.file.close()
+        self.file = None
+
+    def close(self):
+        if self.file is not None:
+            self.seal()
+        self.sync()
+
+
+def import_logs(folder):
+    # moves the .txt logs (and their .npy samples) of an existing folder into its archive
+    logs = sorted(glob(os.path.join(folder, '*.txt')))
+    writer = ArchiveWriter(folder)
+    for log in logs:
+        writer.add(log)
+    writer.close()
+    return len(logs)
@@ -0,0 +1,169 @@
+from .commons import *
+from .exprunner import run_ping_measurments, run_paired_ping_measurments
+from .samples import load_samples
+import shutil
+import signal
+from time import monotonic
+import pandas as pd
+
+'''
+Continuous monitoring: the validated targets are pinged again and again, one round every
+"period" seconds, until a SIGINT/SIGTERM is received.
+The state kept for each target lives in fixed-size ring buffers, so memory does not grow
+with the number of rounds, and the output folders are rotated every few rounds.
+'''
+
+
+class RingBuffer:
+    def __init__(self, size, dtype=np.float32):
+        self.data = np.full(size, np.nan, dtype=dtype)
+        self.size = size
+        self.head = 0
+        self.count = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)[-self.size:]
+        n = len(values)
+        end = self.head + n
+        if end <= self.size:
+            self.data[self.head:end] = values
+        else:
+            split = self.size - self.head
+            self.data[self.head:] = values[:split]
+            self.data[:end - self.size] = values[split:]
+        self.head = end % self.size
+        self.count = min(self.count + n, self.size)
+
+    def values(self):
+        if self.count < self.size:
+            return self.data[:self.count]
+        return np.concatenate((self.data[self.head:], self.data[:self.head]))
+
+
+class RollingStats:
+    def __init__(self, pingable, window, rounds_window):
+        self.pingable = pingable
+        self.rtts = RingBuffer(window)
+        self.losses = RingBuffer(rounds_window)
+        self.rounds = 0
+
+    def update(self, samples):
+        self.rounds += 1
+        if samples is None or len(samples) == 0:
+            self.losses.extend([100.0])
+            return
+        rtts = samples['rtt']
+        lost = np.isnan(rtts)
+        self.rtts.extend(rtts[~lost])
+        self.losses.extend([lost.mean() * 100])
+
+    def summary(self):
+        rtts = self.rtts.values()
+        nan = float('NaN')
+        p50, p95 = np.percentile(rtts, [50, 95]) if len(rtts) else (nan, nan)
+        return [self.pingable.ip, self.pingable.qdn, self.rounds, len(rtts),
+                float(rtts.mean()) if len(rtts) else nan, float(p50), float(p95),
+                float(self.losses.values().mean())]
+
+
+class StopRequest:
+    def __init__(self):
+        self.requested = False
+
+    def install(self):
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(signum, self.handler)
+
+    def handler(self, signum, frame):
+        print("\nReceived signal {}: monitoring stops at the end of this round "
+              "(CTRL+C again to abort it)".format(signum))
+        self.requested = True
+        # un secondo CTRL+C interrompe subito il round in corso
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+
+def rotate_out_dir(outdir, keep, round_number):
+    # out_v4 --> out_v4.<timestamp>_round<N>; only the newest "keep" rotated folders are kept
+    if not os.path.isdir(outdir):
+        return outdir
+    formattedTime = datetime.now().strftime("%d%m%Y-%Hh%Mm%Ss")
+    # il numero del round distingue due rotazioni avvenute nello stesso secondo
+    rotated_dir = "{}.{}_round{}".format(outdir, formattedTime, round_number)
+    os.rename(outdir, rotated_dir)
+    print("Rotated {} to {}".format(outdir, rotated_dir))
+    if keep:
+        rotated = sorted(glob_rotated(outdir), key=os.path.getmtime)
+        for old in rotated[:-keep]:
+            shutil.rmtree(old)
+            print("Removed old output folder {}".format(old))
+    return rotated_dir
+
+
+def glob_rotated(outdir):
+    parent = os.path.dirname(outdir) or '.'
+    prefix = os.path.basename(outdir) + '.'
+    return [os.path.join(parent, d) for d in os.listdir(parent)
+            if d.startswith(prefix) and os.path.isdir(os.path.join(parent, d))]
+
+
+def write_rolling_stats(stats, ip_version):
+    columns = ['IP', 'QDN', 'rounds', 'samples', 'meanRTT', 'p50RTT', 'p95RTT', 'lost']
+    outputfile = "rolling_v{}.csv".format(ip_version)
+    df = pd.DataFrame([s.summary() for s in stats], columns=columns)
+    df.to_csv(outputfile, sep=',', encoding='utf-8', float_format="%.5f", index=False)
+    return outputfile
+
+
+def run_monitoring(ping_list_v4, ping_list_v6, howmany, config, OS, num_parallel, period,
+                   engine='system', paired=False, max_rate=None, dest_rate=None,
+                   window=10000, rounds_window=100, rotate_every=24, keep=None, rule=None, process=None):
+    # process(folder, ip_version): post-processing of a folder, run before it is rotated (and
+    # eventually removed) so that the results of every round are kept
+    stats_v4 = [RollingStats(p, window, rounds_window) for p in ping_list_v4]
+    stats_v6 = [RollingStats(p, window, rounds_window) for p in ping_list_v6]
+    stop = StopRequest()
+    stop.install()
+
+    print('\n# CONTINUOUS MONITORING'.ljust(60, '-'))
+    print("A new round starts every {}s. Send SIGINT or SIGTERM to stop.".format(period))
+
+    outdir_v4, outdir_v6 = "out_v4", "out_v6"
+    round_number = 0
+    while not stop.requested:
+        round_number += 1
+        round_start = monotonic()
+        print("\nROUND #{}".format(round_number))
+
+        # i Pingable validati all'avvio vengono riutilizzati ad ogni round
+        if paired:
+            outdir_v4, outdir_v6 = run_paired_ping_measurments(ping_list_v4, ping_list_v6, howmany, config, OS,
+                                                               num_parallel, engine=engine,
+                                                               max_rate=max_rate, dest_rate=dest_rate, rule=rule)
+        else:
+            outdir_v4 = run_ping_measurments(ping_list_v4, howmany, config, OS, num_parallel, ip_version=4,
+                                             engine=engine, max_rate=max_rate, dest_rate=dest_rate, rule=rule)
+            outdir_v6 = run_ping_measurments(ping_list_v6, howmany, config, OS, num_parallel, ip_version=6,
+                                             engine=engine, max_rate=max_rate, dest_rate=dest_rate, rule=rule)
+
+        for stats, ip_version in [(stats_v4, 4), (stats_v6, 6)]:
+            for s in stats:
+                s.update(load_samples(s.pingable.last_log))
+            outputfile = write_rolling_stats(stats, ip_version)
+            print("Rolling statistics for IPv{} updated in {}".format(ip_version, outputfile))
+
+        if rotate_every and round_number % rotate_every == 0:
+            for outdir, ip_version in [(outdir_v4, 4), (outdir_v6, 6)]:
+                if process is not None and os.path.isdir(outdir):
+                    process(outdir, ip_version)
+                rotate_out_dir(outdir, keep, round_number)
+
+        # attesa fino al prossimo round, controllando ogni secondo se e' arrivato un segnale
+        while not stop.requested and monotonic() - round_start < period:
+            sleep(max(0, min(1, period - (monotonic() - round_start))))
+
+    print("Monitoring stopped after {} rounds".format(round_number))
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # folders still to be post-processed: None if rotated (and processed) in the last round
+    return (outdir_v4 if os.path.isdir(outdir_v4) else None,
+            outdir_v6 if os.path.isdir(outdir_v6) else None)
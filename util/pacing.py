@@ -0,0 +1,88 @@
+from .commons import *
+import asyncio
+from time import monotonic
+
+'''
+Pacing of the echo requests of a campaign.
+A global token bucket caps the aggregate number of probes per second, and a token bucket per
+destination caps the probes sent to the same address, so that raising the number of parallel
+pings does not turn into bursts of ICMP queued on the access link.
+'''
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = monotonic()
+
+    def available_at(self, now):
+        # istante in cui sara' disponibile un token (now, se ce n'e' gia' uno)
+        tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        if tokens >= 1:
+            return now
+        return now + (1 - tokens) / self.rate
+
+    def consume(self, when):
+        # the token is taken at time "when", which may be in the near future
+        self.tokens = min(self.burst, self.tokens + (when - self.last) * self.rate) - 1
+        self.last = when
+
+
+class ProbeScheduler:
+    def __init__(self, max_rate=None, dest_rate=None):
+        self.max_rate = max_rate
+        self.dest_rate = dest_rate
+        self.bucket = TokenBucket(max_rate) if max_rate else None
+        self.dest_buckets = {}
+        self.probes = 0
+        self.first = None
+        self.last = None
+
+    def buckets_for(self, destination):
+        buckets = []
+        if self.bucket is not None:
+            buckets.append(self.bucket)
+        if self.dest_rate:
+            if destination not in self.dest_buckets:
+                self.dest_buckets[destination] = TokenBucket(self.dest_rate)
+            buckets.append(self.dest_buckets[destination])
+        return buckets
+
+    async def acquire(self, destination):
+        # Il token viene prenotato subito su tutti i bucket coinvolti (globale e della
+        # destinazione), cosi' le richieste concorrenti vengono servite in ordine di arrivo
+        now = monotonic()
+        buckets = self.buckets_for(destination)
+        when = max([b.available_at(now) for b in buckets] + [now])
+        for b in buckets:
+            b.consume(when)
+        if self.first is None:
+            self.first = when
+        if when > now:
+            await asyncio.sleep(when - now)
+
+    def account(self, probes):
+        # probes actually sent by a finished measurement
+        self.probes += probes
+        self.last = monotonic()
+
+    def max_concurrent_pings(self, num_parallel, interval):
+        # every ping command sends 1/interval echo requests per second on its own,
+        # so the global rate can only be enforced by limiting how many of them run together
+        if not self.max_rate:
+            return num_parallel
+        return max(1, min(num_parallel, int(self.max_rate * interval)))
+
+    def achieved_rate(self):
+        if self.first is None or self.last is None or self.last <= self.first:
+            return float('NaN')
+        return self.probes / (self.last - self.first)
+
+    def report(self):
+        target = "{} probes/s".format(self.max_rate) if self.max_rate else "unlimited"
+        print("Aggregate probe rate: achieved {:.2f} probes/s (target {})".format(
+            self.achieved_rate(), target))
+        if self.dest_rate:
+            print("Per-destination probe rate capped at {} probes/s".format(self.dest_rate))
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import shutil
+from time import time
+
+'''
+Content-addressed cache of the rendered plots. The key of a figure is a hash of everything
+that feeds it (the code that draws it, its parameters, a hash of the data columns it
+uses...): the same key means the same PDF, so a figure is rendered again only when its key
+changes, otherwise the cached copy is restored. The cache folder holds one file per key and
+index.json (key --> size, last use); when the cache grows beyond max_size bytes, the least
+recently used figures are evicted.
+'''
+
+CACHE_FOLDER = '.plot_cache'
+
+
+def cache_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class PlotCache:
+    def __init__(self, folder=CACHE_FOLDER, max_size=500*1024*1024):
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(folder, exist_ok=True)
+        self.index_file = os.path.join(folder, 'index.json')
+        self.index = {}
+        if os.path.isfile(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    self.index = json.load(f)
+            except ValueError:
+                self.index = {}
+
+    def path(self, key, filename):
+        return os.path.join(self.folder, key + os.path.splitext(filename)[1])
+
+    def fetch(self, key, filename):
+        # restores the cached copy of a figure in filename; False if it has to be rendered
+        entry = self.index.get(key)
+        if entry is None:
+            return False
+        cached = self.path(key, filename)
+        if not os.path.isfile(cached):
+            del self.index[key]
+            return False
+        shutil.copyfile(cached, filename)
+        entry['used'] = time()
+        return True
+
+    def store(self, key, filename):
+        if not os.path.isfile(filename):
+            # nothing was drawn (e.g. no data for this figure)
+            return
+        cached = self.path(key, filename)
+        shutil.copyfile(filename, cached + '.tmp')
+        os.replace(cached + '.tmp', cached)
+        self.index[key] = {'file': os.path.basename(cached), 'size': os.path.getsize(cached), 'used': time()}
+
+    def evict(self):
+        total = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['used']):
+            if total <= self.max_size:
+                break
+            entry = self.index.pop(key)
+            total -= entry['size']
+            try:
+                os.remove(os.path.join(self.folder, entry['file']))
+            except FileNotFoundError:
+                pass
+
+    def save(self):
+        self.evict()
+        with open(self.index_file + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_file + '.tmp', self.index_file)
@@ -1,5 +1,13 @@
 from .commons import *
+from .samples import load_samples, rtt_percentiles
+from .logarchive import open_archive, read_log
+from .probestore import ProbeStore, campaign_label
+from .results import DATE_FORMAT, results_name, save_results, read_results
 from glob import glob
+import io
+import ipaddress
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 
 def compile_regex_logs(OS):
@@ -32,36 +40,67 @@ def build_stats(rttStats, packetsStats):
     return rttDict, packetsDict
 
 
+# The address is in the header of the log (its first line), the statistics in its last lines:
+# only these two parts of the file are read, whatever the number of probes in the log
+HEADER_SIZE = 512
+TAIL_SIZE = 1024
+headerSeparators = re.compile(r"[\s()\[\]]+")
+
+
+def read_header_tail(file):
+    # a log moved into the archive of its folder is decompressed in memory
+    f = open(file, 'rb') if os.path.isfile(file) else io.BytesIO(read_log(file))
+    with f:
+        header = b''
+        # Windows logs start with an empty line
+        for i in range(3):
+            header = f.readline(HEADER_SIZE).strip()
+            if header:
+                break
+        header_end = f.tell()
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(header_end, size - TAIL_SIZE))
+        tail = f.read()
+    return header.decode(errors='replace'), tail.decode(errors='replace')
+
+
+def find_address(header, ip_version):
+    # PING host (1.2.3.4) 56(84) bytes of data. / PING 2001:db8::1(2001:db8::1) 56 data bytes
+    # Pinging 1.2.3.4 with 32 bytes of data: / PING6(56=40+8+8 bytes) fe80::1 --> 2001:db8::1
+    # the target is the last token of the header that is an address of the right version
+    for token in reversed(headerSeparators.split(header)):
+        try:
+            if ipaddress.ip_address(token.split('%')[0]).version == ip_version:
+                return token
+        except ValueError:
+            continue
+    return None
+
+
 def parse_log(file, OS, ip_version):
 
     rttStats, packetsStats = None, None
-    # reading the whole log as a single filestring
-    f = open(file, 'r')
-    filestring = f.read()
-    f.close()
+    header, tail = read_header_tail(file)
     # First of all, get the IP address
-    if ip_version == 4:
-        match = re.search(IPv4regex, filestring)
-    elif ip_version == 6:
-        ip_da_verificare = filestring.split('g ')[1]
-        match = re.search(IPv6regex, ip_da_verificare)
-    if not match:
+    IPaddress = find_address(header, ip_version)
+    if not IPaddress:
         raise Exception(
             "Cannot find an IP address in this log")
-    IPaddress = match.group()
 
     if OS == 'nt':
         # for Windows, easier and equivalent to go directly with deep_parse_log
         rttStats, packetsStats = deep_parse_log(file, OS)
     elif OS == 'posix':
-        match = rttPattern.search(filestring)
-        if match:
-            # extracting the rtt statistics
-            rttStats = list(map(float, match.groups()))
-        match = packetsPattern.search(filestring)
-        if match:
-            # extracting the packets counters statistics
-            packetsStats = list(map(float, match.groups()))
+        for line in tail.splitlines():
+            match = rttPattern.search(line)
+            if match:
+                # extracting the rtt statistics
+                rttStats = list(map(float, match.groups()))
+                continue
+            match = packetsPattern.search(line)
+            if match:
+                # extracting the packets counters statistics
+                packetsStats = list(map(float, match.groups()))
 
     # let's handle all the bad things that could have happened...
     if not rttStats and not packetsStats:
@@ -109,7 +148,7 @@ def deep_parse_log(file, OS):
     # TX is a counter of transmitted packets
     # rtt_values will list all values of rtt found in the log
     TX, RX, rtt_values = 0, 0, []
-    with open(file) as reader:
+    with io.StringIO(read_log(file).decode(errors='replace')) as reader:
         for line in reader.readlines():
             # if the line contains "...=Xms"
             if re.search("\w+=([0-9]+)ms", line):
@@ -213,83 +252,302 @@ def print_mistakes(found_mistakes):
             print("* {}\n  {}".format(e[0], e[1]))
 
 
-def process_logs(folder, OS, ip_version):
+def parse_logs_chunk(logs, OS, ip_version, with_samples=False):
+    # Runs in a worker process: each log has its filename and its body parsed exactly once.
+    # Returns the (log, row, samples) of the valid logs and the mistakes, in the same order of the logs;
+    # the per-probe samples are only returned when they have to be added to the probe store
     compile_regex_logs(OS)
-
-    # Retrieving log files
-    print("Looking for logs inside {}".format(folder))
-    logs = glob(folder+os.sep+"*.txt")
-    print("Found these log-files:")
+    rows, name_mistakes, parse_mistakes = [], [], []
     for log in logs:
-        print(" --> {}".format(log.replace(folder+os.sep, '', 1)))
-
-    bad_formatted_logs = []
-    found_mistakes = []
-    print("\nChecking if logs have a valid filename...\n")
-    for log in logs:
-        logname = log.replace(folder+os.sep, '', 1)
-        print(logname.ljust(90, ' '), end='\r')
         try:
             params = parse_file_name(log)
-            #print("\twell-formatted :)")
         except Exception as e:
             # if log has a bad filename it will not be parsed
-            # for this purpose it is added to the list of bad logs
-            print("ERROR: -> {}".format(logname).ljust(90, ' '))
-            print(e)
-            found_mistakes.append((log, e))
-            bad_formatted_logs.append(log)
-
-    # Only valid logs will be parsed. Bad logs are removed from
-    # the larger set of logs found in the provided folder
-    valid_logs = set(logs) - set(bad_formatted_logs)
-
-    print('CHECK COMPLETED. ValidLogs={} NotValid={}'.format(
-        len(valid_logs), len(bad_formatted_logs)).ljust(90, ' '))
-    print('-'*60)
-
-    results_matrix = []
-    print("\nScanning valid logs to extract ping statistics...\n")
-    for log in valid_logs:
-        # print('-'*60)
-        logname = log.replace(folder+os.sep, '', 1)
-        # print(logname)
-        print(logname.ljust(90, ' '), end='\r')
+            name_mistakes.append((log, e))
+            continue
         try:
             rttDict, packetsDict, IPaddress = parse_log(log, OS, ip_version)
-            #print("{}\n{}".format(rttDict, packetsDict), end='\r')
         except Exception as e:
-            print("ERROR: -> {}".format(logname).ljust(90, ' '))
-            print(e)
-            found_mistakes.append((log, e))
+            parse_mistakes.append((log, e))
             continue
 
-        # Adding this log result to overall results
-        params = parse_file_name(log)
         row = params + [IPaddress]
         row += [rttDict['minRTT'], rttDict['avgRTT'],
                 rttDict['maxRTT'], rttDict['mdevRTT']]
         row += [packetsDict['TX'], packetsDict['RX'], packetsDict['Lost']]
-        results_matrix.append(row)
+        # percentiles come from the per-probe samples saved next to the log (NaN for older logs)
+        samples = load_samples(log)
+        row += rtt_percentiles(samples)
+        rows.append((log, row, samples if with_samples else None))
+    return rows, name_mistakes, parse_mistakes
+
+
+def parse_all_logs(logs, OS, ip_version, workers=None, chunk_size=256, with_samples=False):
+    # Generator: the logs are split in chunks parsed by a pool of processes and the result of
+    # each chunk is yielded in the order of the chunks, so the output does not depend on the
+    # scheduling. Only a few chunks are in flight at a time: parsed rows do not pile up
+    # in memory when the consumer (the writer) is slower than the workers.
+    chunks = (logs[i:i+chunk_size] for i in range(0, len(logs), chunk_size))
+    if len(logs) <= chunk_size or workers == 1:
+        for chunk in chunks:
+            yield parse_logs_chunk(chunk, OS, ip_version, with_samples)
+        return
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(parse_logs_chunk, chunk, OS, ip_version, with_samples))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+MANIFEST_FILE = '.manifest_v{}.json'
+COLUMNS = ['name', 'surname', 'cap', 'operator', 'poa', 'accessTech', 'localTech',
+           'country', 'datetime', 'IP', 'minRTT', 'avgRTT', 'maxRTT', 'mdevRTT', 'TX', 'RX', 'lost',
+           'p50RTT', 'p95RTT', 'p99RTT']
+
+"""
+The manifest, saved inside the log folder, records every log already ingested:
+its size and mtime, the key of its row in the results (datetime, IP) or the error it raised.
+With incremental=True only new or changed logs are parsed, and their rows are added
+to the results file of the previous run.
+"""
+
+
+def file_signature(log):
+    if not os.path.isfile(log):
+        return open_archive(os.path.dirname(log)).signature(os.path.basename(log))
+    stat = os.stat(log)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_manifest(folder, OS, ip_version):
+    filename = os.path.join(folder, MANIFEST_FILE.format(ip_version))
+    empty = {'OS': OS, 'output': None, 'logs': {}}
+    if not os.path.isfile(filename):
+        return empty
+    try:
+        with open(filename) as f:
+            manifest = json.load(f)
+    except ValueError:
+        return empty
+    if manifest.get('OS') != OS or not manifest.get('output') or not os.path.isfile(manifest['output']):
+        # without the results of the previous run every log has to be parsed again
+        return empty
+    return manifest
+
+
+def save_manifest(folder, ip_version, manifest):
+    filename = os.path.join(folder, MANIFEST_FILE.format(ip_version))
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(filename + '.tmp', filename)
+
+
+def drop_stale(old, stale_keys):
+    keys = pd.MultiIndex.from_arrays([pd.to_datetime(old['datetime']).dt.strftime(DATE_FORMAT),
+                                      old['IP'].astype(str)])
+    return old[~keys.isin(stale_keys)]
+
+
+CSV_OPTIONS = dict(sep=',', encoding='utf-8', float_format="%.5f", date_format=DATE_FORMAT, index=False)
+
+
+def truncate_partial_line(filename):
+    # a run interrupted while writing a batch can leave half a row at the end of the results
+    with open(filename, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - 64 * 1024))
+        tail = f.read()
+        if tail and not tail.endswith(b'\n'):
+            f.truncate(size - len(tail) + tail.rfind(b'\n') + 1)
+
+
+def upgrade_header(outputfile, batch_size):
+    # results written before some columns were added (e.g. p50/p95/p99RTT): the file is rewritten
+    # with the current columns, the missing ones left empty, so that the new rows line up with the header
+    with open(outputfile, newline='') as f:
+        header = f.readline().rstrip('\r\n').split(',')
+    if header == COLUMNS:
+        return
+    print("Rewriting {} with the current results columns".format(outputfile))
+    tmpfile = outputfile + '.tmp'
+    first = True
+    for old in pd.read_csv(outputfile, chunksize=batch_size):
+        old.reindex(columns=COLUMNS).to_csv(tmpfile, mode='w' if first else 'a', header=first, **CSV_OPTIONS)
+        first = False
+    os.replace(tmpfile, outputfile)
+
+
+def drop_stale_rows(outputfile, stale_keys, batch_size):
+    # the rows of the logs changed since the last run are removed, reading the results in batches
+    tmpfile = outputfile + '.tmp'
+    header = True
+    for old in pd.read_csv(outputfile, chunksize=batch_size):
+        drop_stale(old, stale_keys).to_csv(tmpfile, mode='w' if header else 'a', header=header, **CSV_OPTIONS)
+        header = False
+    os.replace(tmpfile, outputfile)
+
+
+class ResultsWriter:
+    '''Appends the rows of the results to the CSV in batches of batch_size rows'''
+
+    def __init__(self, outputfile, ip_version, batch_size=5000, flushed=None, append_existing=False):
+        # outputfile: None for a new results file, named after the first row
+        # append_existing: a results file with that name is extended instead of replaced
+        self.outputfile = outputfile
+        self.append_existing = append_existing
+        self.ip_version = ip_version
+        self.batch_size = batch_size
+        # called after every batch is on disk
+        self.flushed = flushed
+        self.append = outputfile is not None
+        if self.append:
+            self.prepare_append()
+        self.rows = []
+        self.written = 0
+
+    def prepare_append(self):
+        if os.path.getsize(self.outputfile) == 0:
+            # nothing to extend, not even the header
+            self.append = False
+            return
+        truncate_partial_line(self.outputfile)
+        upgrade_header(self.outputfile, self.batch_size)
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            if self.outputfile is None:
+                name, surname = self.rows[0][0], self.rows[0][1]
+                self.outputfile = "_".join(["results", name, surname, "v"+str(self.ip_version)])+'.csv'
+                if self.append_existing and os.path.isfile(self.outputfile):
+                    self.append = True
+                    self.prepare_append()
+            df = pd.DataFrame(self.rows, columns=COLUMNS)
+            with open(self.outputfile, 'a' if self.append else 'w', newline='') as f:
+                df.to_csv(f, header=not self.append, **CSV_OPTIONS)
+                f.flush()
+                os.fsync(f.fileno())
+            self.append = True
+            self.written += len(self.rows)
+            self.rows = []
+            print("{} results saved to {}".format(self.written, self.outputfile).ljust(90, ' '), end='\r')
+        if self.flushed:
+            self.flushed()
+
+
+def save_probe_stats(probe_store, added, ip_version):
+    print("{} logs added to the probe store {} ({} probes in total)".format(
+        added, probe_store.folder, len(probe_store.probes())))
+    # statistiche di ogni target calcolate su tutte le sue echo request, di tutti i log
+    outputfile = "probe_stats_v{}.csv".format(ip_version)
+    probe_store.target_stats().to_csv(outputfile, sep=',', encoding='utf-8', float_format="%.5f", index=False)
+    print("Per-target statistics over all the probes saved to {}".format(outputfile))
+
+
+def process_logs(folder, OS, ip_version, workers=None, chunk_size=256, incremental=False, out_format='csv',
+                 store=None, batch_size=5000, append=False):
+    # Retrieving log files
+    print("Looking for logs inside {}".format(folder))
+    # i log archiviati nei segmenti della cartella sono elencati come se fossero ancora file
+    archived = [os.path.join(folder, name) for name in open_archive(folder).names()]
+    logs = sorted(set(glob(folder+os.sep+"*.txt") + archived))
+    manifest = load_manifest(folder, OS, ip_version) if incremental else {'OS': OS, 'output': None, 'logs': {}}
+    entries = manifest['logs']
+    signatures = {log: file_signature(log) for log in logs}
+    new_logs = [log for log in logs
+                if entries.get(os.path.basename(log), {}).get('signature') != signatures[log]]
+    stale_keys = [tuple(entries[os.path.basename(log)]['key']) for log in new_logs
+                  if entries.get(os.path.basename(log), {}).get('key')]
+    if incremental and manifest['output']:
+        print("{} logs already ingested in {}".format(len(logs) - len(new_logs), manifest['output']))
+    print("Found these log-files:")
+    for log in new_logs:
+        print(" --> {}".format(log.replace(folder+os.sep, '', 1)))
+
+    print("\nChecking if logs have a valid filename and scanning them to extract ping statistics...\n")
+    outputfile = manifest['output'] if incremental else None
+    if stale_keys and outputfile:
+        drop_stale_rows(outputfile, stale_keys, batch_size)
+
+    # the manifest (and the probe store) are updated only with the logs whose rows are already
+    # on disk: if the run is interrupted, the next incremental run goes on from the last batch
+    done_entries, store_logs = {}, []
+    probe_store = ProbeStore(store) if store else None
+    added = 0
+    def flushed():
+        nonlocal added
+        entries.update(done_entries)
+        done_entries.clear()
+        if writer.outputfile:
+            manifest['output'] = writer.outputfile
+        if incremental:
+            save_manifest(folder, ip_version, manifest)
+        if store_logs:
+            added += probe_store.ingest(store_logs)
+            store_logs.clear()
+    # append: the rows are added to an existing results file instead of replacing it (e.g. --every)
+    writer = ResultsWriter(outputfile, ip_version, batch_size, flushed, append)
+
+    # summary counters, updated chunk by chunk
+    valid, parsed = 0, 0
+    bad_formatted_logs, parse_mistakes = [], []
+    for rows, name_mistakes, chunk_parse_mistakes in parse_all_logs(new_logs, OS, ip_version, workers, chunk_size,
+                                                                    with_samples=bool(store)):
+        for log, row, samples in rows:
+            done_entries[os.path.basename(log)] = {'signature': signatures[log], 'error': None,
+                                                   'key': [row[8].strftime(DATE_FORMAT), row[9]]}
+            if store:
+                store_logs.append((os.path.basename(log), row[9], campaign_label(row), samples))
+            writer.add(row)
+        for log, e in name_mistakes + chunk_parse_mistakes:
+            done_entries[os.path.basename(log)] = {'signature': signatures[log], 'error': str(e), 'key': None}
+            print("ERROR: -> {}".format(log.replace(folder+os.sep, '', 1)).ljust(90, ' '))
+            print(e)
+        valid += len(rows)
+        parsed += len(rows) + len(name_mistakes) + len(chunk_parse_mistakes)
+        bad_formatted_logs += name_mistakes
+        parse_mistakes += chunk_parse_mistakes
+        print("Parsed {} of {} logs".format(parsed, len(new_logs)).ljust(90, ' '), end='\r')
+    writer.flush()
+
+    # filename mistakes first, as they are found by the check that precedes the scan
+    found_mistakes = bad_formatted_logs + parse_mistakes
+    # the mistakes of the logs ingested by the previous runs are reported again
+    reparsed = set(new_logs)
+    found_mistakes += [(log, entries[os.path.basename(log)]['error']) for log in logs
+                       if log not in reparsed and entries[os.path.basename(log)]['error']]
+
+    print('CHECK COMPLETED. ValidLogs={} NotValid={}'.format(
+        len(new_logs) - len(bad_formatted_logs), len(bad_formatted_logs)).ljust(90, ' '))
 
     # ALL RESULTS AVAILABLE HERE
     print('SCAN COMPLETED'.ljust(90, ' '))
     print('-'*60)
-    columns = ['name', 'surname', 'cap', 'operator', 'poa', 'accessTech', 'localTech',
-               'country', 'datetime', 'IP', 'minRTT', 'avgRTT', 'maxRTT', 'mdevRTT', 'TX', 'RX', 'lost']
-    index = ['name', 'surname', 'IP', 'datetime']
-
-    if results_matrix != []:
-        # retrieving name and surname from last parsed log
-        name, surname = params[0], params[1]
-        outputfile = "_".join(["results", name, surname, "v"+str(ip_version)])+'.csv'
-        df = pd.DataFrame(results_matrix, columns=columns)
-        df.set_index(index)
-        df.to_csv(outputfile, sep=',', encoding='utf-8',
-                  float_format="%.5f", date_format='%Y-%m-%d %H:%M:%S', index=False)
-        print("\n\n", df)
-        print("All your valid results have been saved to {}".format(outputfile))
+
+    resultsfile = writer.outputfile or manifest['output']
+    if out_format != 'csv' and resultsfile and os.path.isfile(resultsfile):
+        # the typed columnar copy of the results is saved next to the CSV, whenever
+        # it is missing or older than the CSV (e.g. --format used for the first time)
+        columnar = results_name(resultsfile, out_format)
+        if not os.path.isfile(columnar) or os.path.getmtime(columnar) < os.path.getmtime(resultsfile):
+            save_results(read_results(resultsfile), columnar)
+            print("Typed results saved to {}".format(columnar))
+    if writer.written or stale_keys:
+        print("{} new results, {} logs parsed".format(valid, parsed))
+        print("All your valid results have been saved to {}".format(writer.outputfile))
+    elif manifest['output']:
+        print("No new results: {} is up to date".format(manifest['output']))
     else:
         print("No useful results to be recorded :(")
+    if probe_store:
+        save_probe_stats(probe_store, added, ip_version)
 
     print_mistakes(found_mistakes)
@@ -0,0 +1,192 @@
+from .commons import *
+import hashlib
+import pandas as pd
+
+'''
+Per-probe time-series store: every echo request of every ingested log, as a fixed-width record
+(target id, seq, send time, rtt, lost flag) appended to a flat binary file that is accessed
+through a read-only memory map. An index holds, for each log, its target, its campaign and
+the slice of records it occupies, so the probes of a target or of a campaign are views on the
+map, and statistics over millions of probes are vectorized reductions instead of log re-parses.
+
+Folder layout (e.g. probes_v4/):
+    probes.dat  PROBE_DTYPE records, grouped by log
+    index.dat   INDEX_DTYPE records, one per log
+    store.json  names of targets, campaigns and logs (their position is their id)
+'''
+
+PROBE_DTYPE = np.dtype([('target', '<u4'), ('seq', '<u4'), ('time', '<f8'), ('rtt', '<f4'), ('lost', 'u1')])
+INDEX_DTYPE = np.dtype([('target', '<u4'), ('campaign', '<u4'), ('start', '<u8'), ('count', '<u4')])
+STATS_COLUMNS = ['IP', 'logs', 'probes', 'lost', 'meanRTT', 'p50RTT', 'p95RTT', 'p99RTT', 'jitter', 'maxLossBurst']
+
+
+def campaign_label(params):
+    # vantage point of a log: everything in its filename but the target and the time
+    name, surname, cap, oper, poa, tech, localtech = params[:7]
+    return "_".join([name, surname, cap, oper, poa, tech, localtech])
+
+
+def fill_times(samples):
+    # the send time of the lost echo requests of the system ping is not known:
+    # it is interpolated from the sequence numbers of the probes that got a reply
+    times = samples['time'].astype(np.float64) if 'time' in samples.dtype.names \
+        else np.full(len(samples), np.nan)
+    known = ~np.isnan(times)
+    if known.sum() >= 2 and not known.all():
+        times[~known] = np.interp(samples['seq'][~known], samples['seq'][known], times[known])
+    return times
+
+
+class ProbeStore:
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.meta_file = os.path.join(folder, 'store.json')
+        self.probes_file = os.path.join(folder, 'probes.dat')
+        self.index_file = os.path.join(folder, 'index.dat')
+        self.meta = {'targets': [], 'campaigns': [], 'logs': []}
+        if os.path.isfile(self.meta_file):
+            with open(self.meta_file) as f:
+                self.meta = json.load(f)
+        self.target_ids = {t: i for i, t in enumerate(self.meta['targets'])}
+        self.campaign_ids = {c: i for i, c in enumerate(self.meta['campaigns'])}
+        self.ingested = set(self.meta['logs'])
+        self.recover()
+
+    def recover(self):
+        # records appended after the last saved store.json (interrupted ingest) are dropped
+        logs = len(self.meta['logs'])
+        if os.path.isfile(self.index_file) and os.path.getsize(self.index_file) > logs * INDEX_DTYPE.itemsize:
+            os.truncate(self.index_file, logs * INDEX_DTYPE.itemsize)
+        index = self.index()
+        end = int(index['start'][-1] + index['count'][-1]) if len(index) else 0
+        if os.path.isfile(self.probes_file) and os.path.getsize(self.probes_file) > end * PROBE_DTYPE.itemsize:
+            os.truncate(self.probes_file, end * PROBE_DTYPE.itemsize)
+
+    def id_of(self, ids, names, name):
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+        return ids[name]
+
+    def ingest(self, logs):
+        # logs: list of (log name, IP, campaign label, samples); already ingested logs are skipped
+        probes, index = [], []
+        start = len(self.probes())
+        for logname, ip, campaign, samples in logs:
+            if logname in self.ingested or samples is None:
+                continue
+            target = self.id_of(self.target_ids, self.meta['targets'], ip)
+            records = np.empty(len(samples), dtype=PROBE_DTYPE)
+            records['target'] = target
+            records['seq'] = samples['seq']
+            records['time'] = fill_times(samples)
+            records['rtt'] = samples['rtt']
+            records['lost'] = np.isnan(samples['rtt'])
+            probes.append(records)
+            index.append((target, self.id_of(self.campaign_ids, self.meta['campaigns'], campaign),
+                          start, len(records)))
+            start += len(records)
+            self.meta['logs'].append(logname)
+            self.ingested.add(logname)
+        if not index:
+            return 0
+        with open(self.probes_file, 'ab') as f:
+            for records in probes:
+                f.write(records.tobytes())
+            os.fsync(f.fileno())
+        with open(self.index_file, 'ab') as f:
+            f.write(np.array(index, dtype=INDEX_DTYPE).tobytes())
+            os.fsync(f.fileno())
+        # store.json is saved last: it makes the new records visible
+        with open(self.meta_file + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(self.meta_file + '.tmp', self.meta_file)
+        return len(index)
+
+    def map(self, filename, dtype):
+        if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r')
+
+    def probes(self):
+        return self.map(self.probes_file, PROBE_DTYPE)
+
+    def index(self):
+        return self.map(self.index_file, INDEX_DTYPE)
+
+    def signature(self):
+        # the folder and a digest of the probes: two stores with the same counts (e.g. probes_v4
+        # and probes_v6 of the same campaign) never share a signature
+        digest = hashlib.sha256(self.probes().tobytes())
+        digest.update(self.index().tobytes())
+        return [os.path.abspath(self.folder), len(self.meta['logs']), len(self.probes()), digest.hexdigest()]
+
+    def select(self, target=None, campaign=None):
+        # probes of a target (IP) and/or of a campaign: a list of zero-copy views, one per log
+        index, probes = self.index(), self.probes()
+        wanted = np.ones(len(index), dtype=bool)
+        if target is not None:
+            wanted &= index['target'] == self.target_ids.get(target, -1)
+        if campaign is not None:
+            wanted &= index['campaign'] == self.campaign_ids.get(campaign, -1)
+        return [probes[int(start):int(start) + int(count)] for start, count in index[['start', 'count']][wanted]]
+
+    def target_stats(self):
+        # statistics of each target over all its probes, computed with a few vectorized passes
+        probes, index = self.probes(), self.index()
+        num_targets = len(self.meta['targets'])
+        if len(probes) == 0:
+            return pd.DataFrame(columns=STATS_COLUMNS)
+        target = probes['target']
+        lost = probes['lost'].astype(bool)
+        rtt = probes['rtt'].astype(np.float64)
+        # log id of each probe, so that jitter and loss bursts do not span two logs
+        log = np.repeat(np.arange(len(index)), index['count'].astype(np.int64))
+
+        sent = np.bincount(target, minlength=num_targets)
+        received = np.bincount(target, weights=~lost, minlength=num_targets)
+        rtt_sum = np.bincount(target[~lost], weights=rtt[~lost], minlength=num_targets)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = rtt_sum / received
+
+        # percentiles: the received RTTs sorted by target, then by value
+        order = np.lexsort((rtt[~lost], target[~lost]))
+        sorted_rtt = rtt[~lost][order]
+        first = np.concatenate(([0], np.cumsum(received)[:-1])).astype(np.int64)
+        values = []
+        for p in (50, 95, 99):
+            position = first + (received - 1) * p / 100
+            low = np.floor(position).astype(np.int64)
+            high = np.ceil(position).astype(np.int64)
+            valid = received > 0
+            value = np.full(num_targets, np.nan)
+            low, high, frac = low[valid], high[valid], (position - np.floor(position))[valid]
+            value[valid] = sorted_rtt[low] + (sorted_rtt[high] - sorted_rtt[low]) * frac
+            values.append(value)
+
+        # jitter: mean absolute difference between consecutive replies of the same log
+        consecutive = (log[1:] == log[:-1]) & ~lost[1:] & ~lost[:-1]
+        diffs = np.abs(np.diff(rtt))[consecutive]
+        jitter_sum = np.bincount(target[1:][consecutive], weights=diffs, minlength=num_targets)
+        jitter_count = np.bincount(target[1:][consecutive], minlength=num_targets)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            jitter = jitter_sum / jitter_count
+
+        # longest run of consecutive lost echo requests
+        new_log = np.concatenate(([True], log[1:] != log[:-1]))
+        end_log = np.concatenate((log[1:] != log[:-1], [True]))
+        previous_lost = np.concatenate(([False], lost[:-1])) & ~new_log
+        next_lost = np.concatenate((lost[1:], [False])) & ~end_log
+        starts = np.flatnonzero(lost & ~previous_lost)
+        ends = np.flatnonzero(lost & ~next_lost)
+        burst = np.zeros(num_targets, dtype=np.int64)
+        np.maximum.at(burst, target[starts], ends - starts + 1)
+
+        logs = np.bincount(index['target'], minlength=num_targets)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            loss = (1 - received / sent) * 100
+        df = pd.DataFrame({'IP': self.meta['targets'], 'logs': logs, 'probes': sent, 'lost': loss,
+                           'meanRTT': mean, 'p50RTT': values[0], 'p95RTT': values[1], 'p99RTT': values[2],
+                           'jitter': jitter, 'maxLossBurst': burst}, columns=STATS_COLUMNS)
+        return df[df['probes'] > 0]
@@ -0,0 +1,74 @@
+from .commons import *
+import asyncio
+import ipaddress
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Local DNS resolution of the QDNs of the target list.
+All the A and AAAA lookups are issued concurrently from one event loop, so resolving the
+whole list takes about as long as its slowest lookup.
+A resolver is any coroutine function resolver(qdn, family) returning a list of addresses:
+by default getaddrinfo is used, HostsResolver reads the records from a hosts file instead.
+'''
+
+
+def normalize_address(address):
+    try:
+        return ipaddress.ip_address(address.split('%')[0]).compressed
+    except ValueError:
+        return address
+
+
+async def getaddrinfo_resolver(qdn, family):
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await loop.getaddrinfo(qdn, None, family=family, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        return []
+    return [info[4][0] for info in infos]
+
+
+class HostsResolver:
+    def __init__(self, hostsfile):
+        self.records = {}
+        with open(hostsfile) as f:
+            for line in f:
+                line = line.split('#')[0].split()
+                if len(line) < 2:
+                    continue
+                address, names = line[0], line[1:]
+                for name in names:
+                    self.records.setdefault(name.lower(), []).append(address)
+
+    async def __call__(self, qdn, family):
+        version = 4 if family == socket.AF_INET else 6
+        return [a for a in self.records.get(qdn.lower(), [])
+                if ipaddress.ip_address(a.split('%')[0]).version == version]
+
+
+async def resolve_qdn(qdn, resolver, timeout):
+    records = []
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            addresses = await asyncio.wait_for(resolver(qdn, family), timeout)
+        except asyncio.TimeoutError:
+            addresses = []
+        records.append(set(normalize_address(a) for a in addresses))
+    return qdn, records[0], records[1]
+
+
+async def resolve_all(qdns, resolver=None, concurrency=64, timeout=10):
+    if resolver is None:
+        resolver = getaddrinfo_resolver
+        # getaddrinfo is blocking: it runs on a thread pool large enough for all the lookups
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        asyncio.get_running_loop().set_default_executor(executor)
+    qdns = list(dict.fromkeys(qdns))
+    results = await asyncio.gather(*[resolve_qdn(qdn, resolver, timeout) for qdn in qdns])
+    return {qdn: (v4, v6) for qdn, v4, v6 in results}
+
+
+def resolve_qdns(qdns, resolver=None, concurrency=64, timeout=10):
+    # returns a dict: qdn --> (set of IPv4 addresses, set of IPv6 addresses)
+    return asyncio.run(resolve_all(qdns, resolver, concurrency, timeout))
@@ -0,0 +1,159 @@
+import os
+import json
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+'''
+Typed results tables, shared by autoping (process_logs) and rtt_plotter (load_data).
+Besides the CSV, results can be saved in a columnar format (Parquet or Feather, through
+pyarrow) that keeps the dtypes: low-cardinality fields are categorical, RTTs float32 and
+datetime a real timestamp, so loading does not parse a single string.
+Values that cannot be converted (a malformed date, a missing TX...) become missing values
+(NaN, NaT, <NA>) instead of raising: the validation of rtt_plotter then reports their rows.
+'''
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+CATEGORICAL = ['name', 'surname', 'cap', 'operator', 'poa', 'accessTech', 'localTech', 'country']
+FLOAT32 = ['minRTT', 'avgRTT', 'maxRTT', 'mdevRTT', 'lost', 'p50RTT', 'p95RTT', 'p99RTT']
+INT32 = ['TX', 'RX']
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+
+def typed_results(df):
+    df = df.copy()
+    for column in CATEGORICAL:
+        # columns read as categorical already (e.g. by read_csv) are left as they are
+        if column in df and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(str).astype('category')
+    for column in FLOAT32:
+        if column in df:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('float32')
+    for column in INT32:
+        if column in df:
+            # nullable integers: an empty cell stays missing
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('Int32')
+    if 'datetime' in df and not pd.api.types.is_datetime64_any_dtype(df['datetime']):
+        df['datetime'] = pd.to_datetime(df['datetime'], format=DATE_FORMAT, errors='coerce')
+    if 'IP' in df:
+        df['IP'] = df['IP'].astype(str)
+    return df
+
+
+def order_categories(df, columns=CATEGORICAL):
+    # only the categories still in use (e.g. after the invalid rows are dropped), in the order
+    # of their first row: the order seaborn gives to the values of a column of strings
+    for column in columns:
+        if column in df and isinstance(df[column].dtype, pd.CategoricalDtype):
+            codes = df[column].cat.codes.to_numpy()
+            used = pd.unique(codes[codes >= 0])
+            df[column] = df[column].cat.set_categories(df[column].cat.categories[used])
+    return df
+
+
+def results_name(outputfile, out_format):
+    # results_<name>_<surname>_v4.csv --> results_<name>_<surname>_v4.parquet
+    return os.path.splitext(outputfile)[0] + FORMATS[out_format]
+
+
+def results_format(filename):
+    extension = os.path.splitext(filename)[1]
+    for out_format, format_extension in FORMATS.items():
+        if extension == format_extension:
+            return out_format
+    raise Exception("{}: unknown results format (expected {})".format(filename, ", ".join(FORMATS.values())))
+
+
+def save_results(df, filename):
+    out_format = results_format(filename)
+    if out_format == 'parquet':
+        typed_results(df).to_parquet(filename, index=False)
+    elif out_format == 'feather':
+        typed_results(df).reset_index(drop=True).to_feather(filename)
+    else:
+        df.to_csv(filename, sep=',', encoding='utf-8', float_format="%.5f", date_format=DATE_FORMAT, index=False)
+
+
+def read_results(filename, columns=None):
+    # columns: the columns to read (those missing in older files are skipped), None for all
+    out_format = results_format(filename)
+    if out_format in ('parquet', 'feather'):
+        df = pd.read_parquet(filename) if out_format == 'parquet' else pd.read_feather(filename)
+        return df[[c for c in columns if c in df]] if columns else df
+    # the CAP is read as a string, so that leading zeros are not lost; the numeric columns are
+    # converted by typed_results, so that a malformed cell does not make the whole file unreadable
+    dtype = {column: 'category' for column in CATEGORICAL}
+    usecols = (lambda column: column in columns) if columns else None
+    return typed_results(pd.read_csv(filename, header=0, dtype=dtype, usecols=usecols))
+
+
+def concat_results(dataframes):
+    # the categories of the files are merged before the concatenation, so the columns stay categorical
+    dataframes = [df for df in dataframes if len(df.columns)]
+    if not dataframes:
+        return pd.DataFrame()
+    for column in CATEGORICAL:
+        if all(column in df and isinstance(df[column].dtype, pd.CategoricalDtype) for df in dataframes):
+            categories = union_categoricals([df[column] for df in dataframes], ignore_order=True).categories
+            for df in dataframes:
+                df[column] = df[column].cat.set_categories(categories)
+    return pd.concat(dataframes, ignore_index=True)
+
+
+"""
+Results of a whole folder (one file for each contributor): the files are read by a pool of
+threads, with their dtypes and only the columns that are needed, the rows found in more
+than one file are kept once, and the consolidated table is cached in the folder as Parquet.
+The cache is used as long as the fingerprints (name, size, mtime) of the files and the
+requested columns do not change.
+"""
+CACHE_FILE = '.results_cache'
+
+
+def results_fingerprint(files, columns):
+    files = [[os.path.basename(f), os.path.getsize(f), os.stat(f).st_mtime_ns] for f in files]
+    return {'files': files, 'columns': columns}
+
+
+def load_cached_results(folder, fingerprint):
+    cache = os.path.join(folder, CACHE_FILE)
+    try:
+        with open(cache + '.json') as f:
+            if json.load(f) != fingerprint:
+                return None
+        return pd.read_parquet(cache + '.parquet')
+    except (OSError, ValueError):
+        return None
+
+
+def save_cached_results(folder, fingerprint, df):
+    cache = os.path.join(folder, CACHE_FILE)
+    try:
+        df.to_parquet(cache + '.parquet.tmp', index=False)
+        os.replace(cache + '.parquet.tmp', cache + '.parquet')
+        # the fingerprint is written last: it makes the cache valid
+        with open(cache + '.json.tmp', 'w') as f:
+            json.dump(fingerprint, f)
+        os.replace(cache + '.json.tmp', cache + '.json')
+    except (OSError, ImportError) as e:
+        print("The consolidated results cannot be cached in {}: {}".format(folder, e))
+
+
+def load_results_folder(folder, files, columns=None, workers=None, use_cache=True):
+    fingerprint = results_fingerprint(files, columns)
+    if use_cache:
+        df = load_cached_results(folder, fingerprint)
+        if df is not None:
+            print("Results of {} files loaded from the cache of {}".format(len(files), folder))
+            return df
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        dataframes = list(executor.map(read_results, files, repeat(columns)))
+    df = concat_results(dataframes)
+    rows = len(df)
+    df = df.drop_duplicates(ignore_index=True)
+    if rows > len(df):
+        print("{} duplicated rows dropped".format(rows - len(df)))
+    if use_cache:
+        save_cached_results(folder, fingerprint, df)
+    return df
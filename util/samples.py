@@ -0,0 +1,156 @@
+from .commons import *
+from .logarchive import open_archive, read_log
+from array import array
+from time import time
+import io
+
+'''
+Per-probe RTT samples of a single ping, kept in compact arrays: sequence numbers (uint32),
+RTTs in ms (float32, NaN for lost echo requests) and send times (epoch seconds, float64,
+NaN when unknown, e.g. for lost echo requests of the system ping).
+The record is saved next to its log, with the same name and the .npy extension.
+'''
+
+SAMPLE_DTYPE = np.dtype([('seq', '<u4'), ('rtt', '<f4'), ('time', '<f8')])
+
+posix_reply_regex = re.compile(r"icmp_seq=([0-9]+) .*time[=<]([0-9]+(?:\.[0-9]+)?) ?ms")
+posix_transmitted_regex = re.compile(r"([0-9]+) packets transmitted")
+# header of the ping of macOS/BSD ("PING host (ip): 56 data bytes", "PING6(56=40+8+8 bytes) ...") and busybox;
+# the colon tells it apart from the IPv6 header of iputils ("PING ::1(::1) 56 data bytes")
+zero_based_header_regex = re.compile(r"^PING .*\): [0-9]+ data bytes|^PING6\(")
+windows_reply_regex = re.compile(r"\w+[=<]([0-9]+)ms")
+windows_missed_regex = re.compile(r"[a-zA-Z ]+\.")
+windows_expired_messages = ['TTL scaduto', 'TTL expired']
+
+
+class ProbeRecord:
+    def __init__(self):
+        self.seq = array('I')
+        self.rtt = array('f')
+        self.time = array('d')
+
+    def __len__(self):
+        return len(self.seq)
+
+    def last_seq(self):
+        # None: no sample yet
+        return self.seq[-1] if self.seq else None
+
+    def next_seq(self):
+        # the samples are numbered from 1
+        return self.seq[-1] + 1 if self.seq else 1
+
+    def add_reply(self, seq, rtt, sent=float('NaN')):
+        if seq < self.next_seq():
+            # duplicate (DUP!) or out of order reply: the first one is kept
+            return
+        # a gap in the icmp_seq numbers means that the echo requests in between were lost
+        self.add_losses(seq - 1)
+        self.seq.append(seq)
+        self.rtt.append(rtt)
+        self.time.append(sent)
+
+    def add_losses(self, up_to_seq):
+        for seq in range(self.next_seq(), up_to_seq + 1):
+            self.seq.append(seq)
+            self.rtt.append(float('NaN'))
+            self.time.append(float('NaN'))
+
+    def to_numpy(self):
+        samples = np.empty(len(self), dtype=SAMPLE_DTYPE)
+        samples['seq'] = np.frombuffer(self.seq, dtype=np.uint32) if self.seq else []
+        samples['rtt'] = np.frombuffer(self.rtt, dtype=np.float32) if self.rtt else []
+        samples['time'] = np.frombuffer(self.time, dtype=np.float64) if self.time else []
+        return samples
+
+    def save(self, logname):
+        np.save(samples_name(logname), self.to_numpy())
+
+    @classmethod
+    def from_rtts(cls, rtts, times=None):
+        record = cls()
+        for seq, rtt in enumerate(rtts, start=1):
+            record.seq.append(seq)
+            record.rtt.append(rtt)
+            record.time.append(times[seq-1] if times is not None else float('NaN'))
+        return record
+
+
+class PingOutputParser:
+    '''Extracts the per-probe samples from the output of ping, one line at a time'''
+
+    def __init__(self, OS, estimate=None):
+        self.OS = OS
+        self.record = ProbeRecord()
+        self.transmitted = None
+        self.header_seen = False
+        # the ping of Linux (iputils) numbers the echo requests from 1, the ones of
+        # macOS/BSD and busybox from 0: the samples are always numbered from 1
+        self.seq_offset = 0
+        # optional RttEstimate, updated with each reply (adaptive probe count)
+        self.estimate = estimate
+
+    def feed(self, line):
+        if not self.header_seen:
+            # the first line only echoes the target of the ping command
+            self.header_seen = bool(line.strip())
+            if zero_based_header_regex.search(line):
+                self.seq_offset = 1
+            return
+        if self.OS == 'posix':
+            match = posix_reply_regex.search(line)
+            if match:
+                seq = int(match.group(1))
+                if seq == 0:
+                    # a header that was not recognised: only 0-based pings send icmp_seq=0
+                    self.seq_offset = 1
+                self.add_reply(seq + self.seq_offset, float(match.group(2)))
+                return
+            match = posix_transmitted_regex.search(line)
+            if match:
+                self.transmitted = int(match.group(1))
+        elif self.OS == 'nt':
+            # Windows does not print the sequence number: replies are numbered as they come
+            match = windows_reply_regex.search(line)
+            if match:
+                self.add_reply(self.record.next_seq(), float(match.group(1)))
+            elif windows_missed_regex.match(line) or any(x in line for x in windows_expired_messages):
+                self.record.add_losses(self.record.next_seq())
+
+    def add_reply(self, seq, rtt):
+        if self.estimate is not None and seq >= self.record.next_seq():
+            self.estimate.add(rtt)
+        # the output is parsed while ping runs: the echo request left one RTT ago
+        self.record.add_reply(seq, rtt, time() - rtt / 1000)
+
+    def close(self):
+        # the echo requests sent after the last reply have been lost as well
+        if self.transmitted is not None:
+            self.record.add_losses(self.transmitted)
+        return self.record
+
+
+def samples_name(logname):
+    return os.path.splitext(logname)[0] + '.npy'
+
+
+def load_samples(logname):
+    filename = samples_name(logname)
+    if os.path.isfile(filename):
+        return np.load(filename)
+    if os.path.isfile(logname):
+        # a log saved without its samples (e.g. by an older version of autoping)
+        return None
+    if os.path.basename(filename) in open_archive(os.path.dirname(filename)):
+        return np.load(io.BytesIO(read_log(filename)))
+    return None
+
+
+def rtt_percentiles(samples, percentiles=(50, 95, 99)):
+    nan = float('NaN')
+    if samples is None:
+        return [nan for p in percentiles]
+    rtts = samples['rtt'][~np.isnan(samples['rtt'])]
+    if len(rtts) == 0:
+        return [nan for p in percentiles]
+    return [float(p) for p in np.percentile(rtts, percentiles)]
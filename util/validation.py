@@ -0,0 +1,130 @@
+import warnings
+from abc import ABC, abstractmethod
+import numpy as np
+import pandas as pd
+
+'''
+Column validation for the results tables, with the same interface as pandas_schema (Schema,
+Column, *Validation), used by rtt_plotter.validate. The errors are collected column by column
+and then sorted by row (a stable sort, so the columns keep their order within a row), as the
+Schema.validate of pandas_schema does.
+pandas_schema checks a cell at a time (strptime per row, a regex per row, a Python object
+per cell); here every check works on whole columns: range masks on the numeric arrays,
+isin for the closed sets, a single vectorized datetime parse and regular expressions run
+once per distinct value (the categories of a categorical column) and broadcast to the rows.
+'''
+
+
+class ValidationWarning:
+    def __init__(self, message, value=None, row=-1, column=None):
+        self.message = message
+        self.value = value
+        self.row = row
+        self.column = column
+
+    def __str__(self):
+        if self.row is not None and self.column is not None and self.value is not None:
+            return '{{row: {}, column: "{}"}}: "{}" {}'.format(self.row, self.column, self.value, self.message)
+        return self.message
+
+
+def by_value(series, check):
+    # check runs once for each distinct value (as a string, like pandas_schema) and is broadcast to the rows
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        values = pd.Series(list(series.cat.categories.astype(str)) + ['nan'], dtype=object)
+        # the code of a missing value is -1: the last element, 'nan'
+        return check(values).to_numpy(dtype=bool)[series.cat.codes.to_numpy()]
+    codes, uniques = pd.factorize(series.astype(str))
+    return check(pd.Series(uniques, dtype=object)).to_numpy(dtype=bool)[codes]
+
+
+class Validation(ABC):
+    @abstractmethod
+    def validate(self, series):
+        # boolean array, True for the valid cells
+        pass
+
+    def get_errors(self, series, column):
+        failed = ~self.validate(series)
+        if column.allow_empty:
+            if isinstance(series.dtype, pd.CategoricalDtype) or pd.api.types.is_numeric_dtype(series):
+                failed &= series.notna().to_numpy()
+            else:
+                failed &= (series.str.len() > 0).to_numpy()
+        rows = np.flatnonzero(failed)
+        if len(rows) == 0:
+            return []
+        return [ValidationWarning(self.message, value, row, series.name)
+                for row, value in zip(series.index[rows], series.iloc[rows])]
+
+
+class MatchesPatternValidation(Validation):
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.message = 'does not match the pattern "{}"'.format(pattern)
+
+    def validate(self, series):
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", 'This pattern .* match groups')
+            return by_value(series, lambda values: values.str.contains(self.pattern))
+
+
+class InRangeValidation(Validation):
+    def __init__(self, min=-np.inf, max=np.inf):
+        # min included, max excluded
+        self.min = min
+        self.max = max
+        self.message = 'was not in the range [{}, {})'.format(min, max)
+
+    def validate(self, series):
+        values = pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        with np.errstate(invalid='ignore'):
+            return (values >= self.min) & (values < self.max)
+
+
+class InListValidation(Validation):
+    def __init__(self, options):
+        self.options = options
+        self.message = 'is not in the list of legal options ({})'.format(', '.join(str(v) for v in options))
+
+    def validate(self, series):
+        return series.isin(self.options).to_numpy(dtype=bool)
+
+
+class DateFormatValidation(Validation):
+    def __init__(self, date_format):
+        self.date_format = date_format
+        self.message = 'does not match the date format string "{}"'.format(date_format)
+
+    def validate(self, series):
+        if pd.api.types.is_datetime64_any_dtype(series):
+            # already parsed (typed results): only missing dates are not valid
+            return series.notna().to_numpy()
+        dates = pd.to_datetime(series.astype(str), format=self.date_format, errors='coerce')
+        return dates.notna().to_numpy()
+
+
+class Column:
+    def __init__(self, name, validations=[], allow_empty=False):
+        self.name = name
+        self.validations = validations
+        self.allow_empty = allow_empty
+
+    def validate(self, series):
+        return [error for validation in self.validations for error in validation.get_errors(series, self)]
+
+
+class Schema:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def get_column_names(self):
+        return [column.name for column in self.columns]
+
+    def validate(self, df):
+        if len(df.columns) != len(self.columns):
+            return [ValidationWarning('Invalid number of columns. The schema specifies {}, but the data frame has {}'
+                                      .format(len(self.columns), len(df.columns)))]
+        errors = [error for column in self.columns for error in column.validate(df[column.name])]
+        # like pandas_schema: sorted by row, in column order within the same row
+        return sorted(errors, key=lambda e: e.row)